@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Spec Benchmark - synthetic dashboard spec workbooks and timings for createSpecification.py.
+
+    This script writes dashboard spec workbooks with the sheet titles, version row and
+    NettingSpec qbox layout createSpecification.py expects, and times each stage of a
+    conversion against them: opening the workbook, locating the qbox headers and footers,
+    importing the qboxes and running each print* emitter. Results are written as json so
+    runs from different versions of the script can be compared.
+
+    Writing .xls workbooks needs xlwt; writing .xlsx workbooks needs openpyxl.
+
+    Use cases:
+        $ benchmarkSpecification.py -g <spec.xls> [-n <qboxes>] [--responses 3-7] [--label-length 12]
+                                    [--non-ascii] [--netting mixed] [--version april]
+            - write a single synthetic spec workbook.
+        $ benchmarkSpecification.py [--sizes 10,100,1000,10000] [--repeat 3] [-o results.json]
+            - time every stage for each qbox count and write the results.
+        $ benchmarkSpecification.py -o new.json --compare old.json
+            - as above, then print each stage's time relative to an earlier run.
+"""
+import sys, os
+import optparse, random, time
+import tempfile, shutil, json, platform
+import cStringIO
+
+import xlrd
+import createSpecification
+
+VERSION_ROWS = {
+    "march": "Updated 15 March 2013",
+    "april": "Updated 5 April 2013",
+}
+OTHER_SHEETS = ['DPSpec-->DP', 'Net-List', 'Costs', 'Lists']
+NETTING_PATTERNS = ["none", "builtin", "custom", "mixed"]
+
+WORDS = ["agree", "disagree", "strongly", "somewhat", "neither", "likely", "unlikely", "very",
+         "not", "at", "all", "much", "more", "less", "definitely", "would", "buy", "recommend"]
+NON_ASCII_WORDS = [u"tr\xe8s", u"d\xe9finitivement", u"\xfcberhaupt", u"gro\xdf", u"a\xf1o",
+                   u"\xe7a", u"r\xe9sum\xe9", u"na\xefve"]
+
+# Builds a label of roughly the given length from random words
+def make_label(rand, length, nonAscii):
+
+    words = []
+    while len(u" ".join(words)) < length:
+        if nonAscii and rand.random() < 0.3:
+            words.append(rand.choice(NON_ASCII_WORDS))
+        else:
+            words.append(rand.choice(WORDS))
+
+    return u" ".join(words)[:max(length, 1)].strip().capitalize() or u"Label"
+
+# Net number sequences which createSpecification can import: they start at 1 and
+# never step by more than 1, so every net category gets one run of net labels.
+def importable(netNumbers):
+
+    if not netNumbers or netNumbers[0] != 1:
+        return False
+    for i in range(1, len(netNumbers)):
+        if netNumbers[i] - netNumbers[i-1] not in (0, 1):
+            return False
+    return True
+
+BUILTIN_SEQUENCES = sorted([[int(n) for n in sequence] for sequence in createSpecification.NETTING_INDEX \
+                                                      if importable([int(n) for n in sequence])])
+
+# Picks the net numbers of one qbox
+# Input: a random generator, the number of responses, a netting pattern
+# Output: a list of net numbers
+def make_net_numbers(rand, responses, pattern):
+
+    if pattern == "mixed":
+        pattern = rand.choice(["none", "builtin", "custom"])
+
+    if pattern == "builtin":
+        candidates = [sequence for sequence in BUILTIN_SEQUENCES if len(sequence) == responses]
+        if candidates:
+            return list(rand.choice(candidates))
+        pattern = "custom"
+
+    if pattern == "custom":
+        netNumbers = [1]
+        for i in range(1, responses):
+            netNumbers.append(netNumbers[-1] + rand.choice([0, 1]))
+        return netNumbers
+
+    return range(1, responses + 1)
+
+# Lays out the cells of a synthetic spec
+# Output: a dict of sheet title -> list of (row, col, value)
+def make_spec_cells(qboxes=100, minResponses=3, maxResponses=7, labelLength=12, nonAscii=False,
+                    netting="mixed", version="april", seed=0):
+
+    rand = random.Random(seed)
+
+    dashboardCells = [(0, 0, u"Dashboard Specification"), (0, 3, VERSION_ROWS[version]),
+                      (2, 0, u"Study"), (2, 1, u"Synthetic benchmark study")]
+
+    nettingCells = [(0, 1, u"Active"), (0, 2, u"Variable"), (0, 4, u"Net / Dashboard label")]
+    row = 1
+    for q in range(qboxes):
+        responses = rand.randint(minResponses, maxResponses)
+        netNumbers = make_net_numbers(rand, responses, netting)
+        netLabels = [make_label(rand, labelLength, nonAscii) for n in range(max(netNumbers))]
+        # consecutive net categories need different labels to be told apart
+        for n in range(1, len(netLabels)):
+            if netLabels[n] == netLabels[n-1]:
+                netLabels[n] += u" %d" % (n + 1)
+
+        # header row, key row, then one row per response; the next header ends the qbox
+        nettingCells.append((row, 1, u"Yes"))
+        nettingCells.append((row, 2, u"Q%05d" % (q + 1)))
+        nettingCells.append((row, 4, make_label(rand, labelLength * 2, nonAscii)))
+        nettingCells.append((row + 1, 1, u"Value"))
+        nettingCells.append((row + 1, 4, u"Net"))
+        for i in range(responses):
+            nettingCells.append((row + 2 + i, 1, float(i + 1)))
+            nettingCells.append((row + 2 + i, 4, float(netNumbers[i])))
+            nettingCells.append((row + 2 + i, 5, netLabels[netNumbers[i] - 1]))
+        row += 2 + responses
+
+    nettingCells.append((row, 4, u"End of questions"))
+
+    cells = {'DashboardSpec-->CS': dashboardCells, 'NettingSpec-->': nettingCells}
+    for title in OTHER_SHEETS:
+        cells[title] = [(0, 0, title)]
+
+    return cells
+
+SHEET_ORDER = ['DashboardSpec-->CS', 'DPSpec-->DP', 'NettingSpec-->', 'Net-List', 'Costs', 'Lists']
+XLS_MAX_ROWS = 65536
+
+def netting_rows(cells):
+
+    return max([row for row, col, value in cells['NettingSpec-->']]) + 1
+
+def write_xls(filename, cells):
+
+    try:
+        import xlwt
+    except ImportError:
+        print "writing .xls spec workbooks needs the xlwt package."
+        sys.exit(1)
+
+    if netting_rows(cells) > XLS_MAX_ROWS:
+        print "too many rows for an .xls workbook; write an .xlsx workbook instead."
+        sys.exit(1)
+
+    workbook = xlwt.Workbook(encoding='utf-8')
+    for title in SHEET_ORDER:
+        sheet = workbook.add_sheet(title)
+        for row, col, value in cells[title]:
+            sheet.write(row, col, value)
+    workbook.save(filename)
+
+def write_xlsx(filename, cells):
+
+    try:
+        import openpyxl
+    except ImportError:
+        print "writing .xlsx spec workbooks needs the openpyxl package."
+        sys.exit(1)
+
+    workbook = openpyxl.Workbook(write_only=True)
+    for title in SHEET_ORDER:
+        sheet = workbook.create_sheet(title)
+        rows = {}
+        for row, col, value in cells[title]:
+            rows.setdefault(row, {})[col] = value
+        # write only sheets are appended a row at a time
+        for row in range(max(rows) + 1):
+            values = rows.get(row, {})
+            sheet.append([values.get(col) for col in range(max(values) + 1)] if values else [])
+    workbook.save(filename)
+
+# Writes a synthetic spec workbook; the extension picks .xls or .xlsx
+def generate_spec(filename, **options):
+
+    write_spec_cells(filename, make_spec_cells(**options))
+
+def write_spec_cells(filename, cells):
+
+    if os.path.splitext(filename)[1].lower() == '.xlsx':
+        write_xlsx(filename, cells)
+    else:
+        write_xls(filename, cells)
+
+# Runs fn repeat times
+# Output: the fastest wall time in seconds, and fn's result from the last run
+def time_stage(fn, repeat):
+
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, result
+
+# Times each conversion stage on one workbook
+# Output: a dict of stage name -> seconds
+def benchmark_workbook(filename, repeat):
+
+    stages = {}
+    # every timed open leaves a workbook behind; all of them are released at the end
+    workbooks = []
+
+    def open_netting_sheet():
+        workbook = createSpecification.open_spec_workbook(filename)
+        workbooks.append(workbook)
+        return workbook.sheet_by_name('NettingSpec-->')
+
+    try:
+        stages["open"], worksheet = time_stage(open_netting_sheet, repeat)
+        stages["locate_qboxHeaderRows"], headers = time_stage(
+            lambda: createSpecification.locate_qboxHeaderRows(worksheet), repeat)
+        stages["locate_qbox_footers"], dimensions = time_stage(
+            lambda: createSpecification.locate_qbox_footers(worksheet, headers), repeat)
+        stages["import_qboxes"], questionData = time_stage(
+            lambda: createSpecification.import_qboxes(worksheet, dimensions), repeat)
+
+        if createSpecification.numpy is not None:
+            stages["ColumnSnapshot"], snapshot = time_stage(
+                lambda: createSpecification.ColumnSnapshot(worksheet), repeat)
+            stages["snapshot_qboxHeaderRows"], headers = time_stage(
+                lambda: createSpecification.snapshot_qboxHeaderRows(snapshot), repeat)
+            stages["snapshot_qbox_footers"], dimensions = time_stage(
+                lambda: createSpecification.snapshot_qbox_footers(snapshot, headers), repeat)
+            stages["import_qboxes (snapshot)"], questionData = time_stage(
+                lambda: createSpecification.import_qboxes(snapshot, dimensions), repeat)
+
+        for emitter in ["printYamlHeader", "printQuestions", "printAnswers", "printCustomNetting"]:
+            fn = getattr(createSpecification, emitter)
+            if emitter == "printYamlHeader":
+                stages[emitter], output = time_stage(lambda: fn(cStringIO.StringIO()), repeat)
+            else:
+                stages[emitter], output = time_stage(lambda: fn(questionData, cStringIO.StringIO()), repeat)
+    finally:
+        for workbook in workbooks:
+            workbook.release_resources()
+
+    return stages
+
+# Generates a workbook for each qbox count and benchmarks it
+# Output: the results as a json-ready dict
+def run_benchmarks(sizes, repeat, workDir, extension, seed):
+
+    results = []
+    for size in sizes:
+        cells = make_spec_cells(qboxes=size, seed=seed)
+        # the largest specs do not fit in an .xls sheet
+        sizeExtension = extension
+        if extension == ".xls" and netting_rows(cells) > XLS_MAX_ROWS:
+            sizeExtension = ".xlsx"
+
+        filename = os.path.join(workDir, "spec_%d%s" % (size, sizeExtension))
+        write_spec_cells(filename, cells)
+        stages = benchmark_workbook(filename, repeat)
+        results.append({"qboxes": size, "format": sizeExtension, "bytes": os.path.getsize(filename),
+                        "stages": stages})
+
+        print "%6d qboxes: %s" % (size, ", ".join(["%s %.4fs" % (stage, stages[stage]) \
+                                                          for stage in sorted(stages)]))
+
+    return {
+        "parserVersion": createSpecification.PARSER_VERSION,
+        "python": platform.python_version(),
+        "xlrd": xlrd.__VERSION__,
+        "numpy": createSpecification.numpy.__version__ if createSpecification.numpy is not None else None,
+        "repeat": repeat,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+
+# Prints each stage's time in a new run relative to an earlier one
+def print_comparison(baseline, current):
+
+    baselineResults = dict([(result["qboxes"], result["stages"]) for result in baseline["results"]])
+
+    print "stage times relative to parser version " + str(baseline.get("parserVersion")) + \
+          " (" + str(baseline.get("timestamp")) + "):"
+    for result in current["results"]:
+        if result["qboxes"] not in baselineResults:
+            continue
+        old = baselineResults[result["qboxes"]]
+        for stage in sorted(result["stages"]):
+            if stage in old and old[stage] > 0:
+                print "%6d qboxes  %-28s %8.4fs -> %8.4fs  (x%.2f)" % (result["qboxes"], stage, old[stage],
+                                                  result["stages"][stage], result["stages"][stage] / old[stage])
+
+def main():
+
+    parser = optparse.OptionParser(usage="usage: %prog [-g <spec.xls>] [options]")
+    parser.add_option("-g", "--generate", dest="generate", metavar="FILE",
+                      help="write one synthetic spec workbook (.xls or .xlsx) and exit")
+    parser.add_option("-n", "--qboxes", dest="qboxes", type="int", default=100,
+                      help="generate: number of qboxes (default: %default)")
+    parser.add_option("--responses", dest="responses", default="3-7", metavar="MIN-MAX",
+                      help="generate: responses per qbox (default: %default)")
+    parser.add_option("--label-length", dest="labelLength", type="int", default=12,
+                      help="generate: approximate length of net labels (default: %default)")
+    parser.add_option("--non-ascii", dest="nonAscii", action="store_true", default=False,
+                      help="generate: use accented words in the labels")
+    parser.add_option("--netting", dest="netting", type="choice", choices=NETTING_PATTERNS, default="mixed",
+                      help="generate: netting pattern, one of " + ", ".join(NETTING_PATTERNS) + \
+                           " (default: %default)")
+    parser.add_option("--version", dest="version", type="choice", choices=sorted(VERSION_ROWS),
+                      default="april", help="generate: version row to write (default: %default)")
+    parser.add_option("--seed", dest="seed", type="int", default=0)
+    parser.add_option("--sizes", dest="sizes", default="10,100,1000,10000",
+                      help="benchmark: comma separated qbox counts (default: %default)")
+    parser.add_option("--repeat", dest="repeat", type="int", default=3,
+                      help="benchmark: runs per stage, the fastest is kept (default: %default)")
+    parser.add_option("--xlsx", dest="xlsx", action="store_true", default=False,
+                      help="benchmark: generate .xlsx instead of .xls workbooks")
+    parser.add_option("-o", "--output", dest="output", metavar="FILE",
+                      help="benchmark: write the results as json to FILE")
+    parser.add_option("--compare", dest="compare", metavar="FILE",
+                      help="benchmark: compare against results written by an earlier run")
+    parser.add_option("--keep-dir", dest="keepDir", metavar="DIR",
+                      help="benchmark: keep the generated workbooks in DIR")
+    (options, args) = parser.parse_args()
+
+    if options.generate:
+        minResponses, maxResponses = [int(n) for n in options.responses.split("-")]
+        generate_spec(options.generate, qboxes=options.qboxes, minResponses=minResponses,
+                      maxResponses=maxResponses, labelLength=options.labelLength,
+                      nonAscii=options.nonAscii, netting=options.netting,
+                      version=options.version, seed=options.seed)
+        return
+
+    sizes = [int(size) for size in options.sizes.split(",")]
+    extension = ".xlsx" if options.xlsx else ".xls"
+
+    if options.keepDir:
+        if not os.path.isdir(options.keepDir):
+            os.makedirs(options.keepDir)
+        workDir = options.keepDir
+    else:
+        workDir = tempfile.mkdtemp(prefix="specbench")
+    try:
+        report = run_benchmarks(sizes, options.repeat, workDir, extension, options.seed)
+    finally:
+        if not options.keepDir:
+            shutil.rmtree(workDir)
+
+    if options.output:
+        outputFile = open(options.output, 'w')
+        try:
+            json.dump(report, outputFile, indent=2, sort_keys=True)
+        finally:
+            outputFile.close()
+
+    if options.compare:
+        baselineFile = open(options.compare)
+        try:
+            baseline = json.load(baselineFile)
+        finally:
+            baselineFile.close()
+        print_comparison(baseline, report)
+
+if __name__ == "__main__":
+	main()
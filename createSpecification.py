@@ -11,7 +11,6 @@
     http://www.lexicon.net/sjmachin/xlrd.html
 
     Changes in progress:
-        - in import_qboxes, change return type to dictionary for information collected for each question
         - implement yaml file output function
         - Add exception handling
         - Add optparse
@@ -19,193 +18,447 @@
               $ createSpecification.py
                   - print help
               $ createSpecification.py -d <dashboard_xls_filename>
-                  - generate a yaml file template, populate all sections except for the header
+                  - generate a yaml file template, populate all sections. The studies, vars and
+                    ->videos header sections are read from the DashboardSpec and DPSpec sheets
+                    ->in the same pass as the NettingSpec; fields not found keep their placeholders.
               $ createSpecification.py -d <dashboard_xls_filename> -c
                   - prompt user to enter details needed for yaml header, then generate yaml file.
-              $ createSpecification.py -d <dashboard_xls_filename> -x <desparsed_csv_filename>
-                  - in addition to the functionality of -c, alter the output yaml to reflect
-                    ->the presence of empty 9999 cells within the desparses csv file.
+              $ createSpecification.py <dashboard_xls_filename> -x <desparsed_csv_filename> [-j <jobs>]
+                  - alter the output yaml to reflect the presence of empty 9999 cells within the
+                    ->desparsed csv file. The questions whose columns use 9999 or -99.99 are
+                    ->listed on stderr.
+              $ createSpecification.py <dashboard_xls_filename> -x <desparsed_csv_filename> --histograms
+                  - count the response codes of every question's column in the desparsed csv and
+                    ->flag codes declared but never observed, or observed but never declared.
+                    ->Exits non-zero if the data uses codes the spec does not declare.
+              $ createSpecification.py <dashboard_xls_filename> -f <output_filename>
+                  - stream the generated yaml into a file instead of stdout.
+              $ <command writing a workbook> | createSpecification.py - [-f <output_filename>]
+                  - read the workbook from stdin instead of a file; it is parsed in memory without
+                    ->a temporary copy. Workbook files are memory-mapped rather than read.
+              $ createSpecification.py <dashboard_xls_filename> -f <output_filename> -i
+                  - re-extract only the questions changed since the last run and patch them in.
+              $ createSpecification.py -b <directory_or_glob> [-o <output_dir>] [-j <jobs>]
+                  - convert every spec workbook found, one .dcc.yaml file each, using a process pool.
+              $ createSpecification.py -b <directory_or_glob> [-o <output_dir>] --netting-library <file>
+                  - name equal custom nettings after their contents across every spec, and write them
+                    ->once to a library file which each .dcc.yaml references instead of its own.
+              $ createSpecification.py <dashboard_xls_filename> [-f <output_filename>] --legacy-nettings
+                  - write every built-in netting into customNetting, as older versions did; by default
+                    ->only the built-in nettings which the spec's questions use are written.
+              $ createSpecification.py <dashboard_xls_filename> -f <output_filename> --format yaml,json,msgpack
+                  - write the same spec as compact json and/or MessagePack as well, from a single parse.
+              $ createSpecification.py <dashboard_xls_filename> --cache [--cache-dir <dir>]
+                  - reuse the model parsed from an identical workbook instead of parsing it again.
+              $ createSpecification.py --cache-info | --cache-clear
+                  - inspect or empty the model cache.
+              $ createSpecification.py <dashboard_xls_filename> --check
+              $ createSpecification.py -b <directory_or_glob> --check
+                  - validate every qbox and report all spec errors with their cells, without
+                    ->writing yaml. Exits non-zero if any are found.
+              $ createSpecification.py --serve <socket> [--watch <directory> [-o <output_dir>]] [--cache]
+                  - stay resident and answer json conversion requests on a unix socket, keeping
+                    ->parsed models in memory; optionally regenerate outputs as workbooks change.
+              $ createSpecification.py <dashboard_xls_filename> --profile [--profile-trace <trace.json>]
+                  - report per-stage timings, peak memory and cell reads on stderr.
+              >>> model = createSpecification.load_spec(contents=open(<dashboard_xls_filename>, 'rb').read())
+              >>> model.write(out, "json")
+                  - use the converter as a library: load_spec returns a SpecModel which renders to any
+                    ->stream, and spec problems are raised as SpecError subclasses instead of exiting.
 """
 import sys, os
 import xlrd, re
 import unicodedata
+import glob, optparse, multiprocessing
+import cStringIO, tempfile, shutil
+import hashlib, cPickle, json
+import csv, mmap
+import array
+import zipfile, xml.etree.cElementTree as ElementTree
+import time, contextlib, logging
+import SocketServer, socket, threading, collections, operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Progress and warning messages go to this logger: informational messages at INFO,
+# the per question import trace at DEBUG. Nothing is shown unless the caller
+# configures logging (the command line does, see main).
+logger = logging.getLogger("createSpecification")
+logger.addHandler(logging.NullHandler())
+
+ACCEPTED_FORMATS = ['.xls', '.xlsm', '.xlsx']
+
+# write_spec holds the answers and customNetting sections in memory up to this
+# many bytes each before spooling them to a temporary file
+SPOOL_SIZE = 1 << 20
+# buffer size used for .dcc.yaml output files
+OUTPUT_BUFFER_SIZE = 1 << 16
+# permissions of output files, which are written to temporary files first
+OUTPUT_UMASK = os.umask(0)
+os.umask(OUTPUT_UMASK)
+OUTPUT_FILE_MODE = 0666 & ~OUTPUT_UMASK
+
+# Bump whenever a change to the extractors changes the imported question data,
+# so models cached by an older version of this script are not reused.
+PARSER_VERSION = "5"
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "createSpecification")
+DEFAULT_CACHE_SIZE = 256 << 20
+
+# Errors. Everything that stops a spec from being converted raises a SpecError
+# whose message is what the command line prints; status is the exit status the
+# command line uses for it.
+class SpecError(Exception):
+
+    status = 1
+
+# The spec file does not exist or is not a workbook this script reads
+class SpecFileError(SpecError):
+
+    status = 0
+
+# The workbook is not one of the spec layouts in SPEC_LAYOUTS
+class SpecLayoutError(SpecError):
+    pass
+
+# A qbox cell could not be imported
+class QboxImportError(SpecError):
+
+    status = 0
+
+# The NettingSpec sheet has errors (see validate_qboxes); errors holds the
+# (row, column, message) tuples and plan the ExtractionPlan of the layout
+class SpecValidationError(SpecError):
+
+    def __init__(self, errors, plan):
+        SpecError.__init__(self, format_spec_errors(errors, plan))
+        self.errors = errors
+        self.plan = plan
+
+# The imported questions would make an inconsistent spec (see SpecModelCheck);
+# errors holds one message per problem
+class SpecModelError(SpecError):
+
+    def __init__(self, errors):
+        SpecError.__init__(self, format_model_errors(errors))
+        self.errors = errors
+
+# Another daemon is already listening on the socket given to --serve
+class DaemonRunningError(SpecError):
+    pass
+
+# most distinct strings whose ASCII form AsciiText keeps before starting over
+ASCII_CACHE_SIZE = 1 << 16
+
+# Reduces worksheet text to ASCII (NFKD, then anything non-ASCII dropped). A spec
+# repeats the same few labels thousands of times, and xlrd hands out the same
+# string for every cell sharing an entry of the shared string table, so each
+# distinct string is only normalized once and then served from a memo, which is
+# emptied whenever it reaches maxEntries.
+class AsciiText(object):
+
+    def __init__(self, maxEntries=ASCII_CACHE_SIZE):
+        self.maxEntries = maxEntries
+        self.memo = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, text):
+        try:
+            result = self.memo[text]
+            self.hits += 1
+            return result
+        except KeyError:
+            pass
+
+        self.misses += 1
+        if len(self.memo) >= self.maxEntries:
+            self.memo.clear()
+        result = self.memo[text] = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore')
+        return result
+
+    def hit_rate(self):
+        if not (self.hits + self.misses):
+            return 0.0
+        return float(self.hits) / (self.hits + self.misses)
+
+ascii_text = AsciiText()
+
+# The data imported from one qbox. Response values and net numbers are kept in
+# float arrays and the labels and names are interned, since the same few labels
+# repeat across most questions of a spec.
+class Question(object):
+
+    __slots__ = ('number', 'variableName', 'dashboardLabel', 'responseValues', 'netNumbers', \
+                 'netLabels', 'nettingName', 'missingCodes')
+
+    def __init__(self, number, variableName, dashboardLabel, responseValues, netNumbers, \
+                                              netLabels, nettingName, missingCodes=()):
+        self.number = number
+        self.variableName = intern(str(variableName))
+        self.dashboardLabel = intern(str(dashboardLabel))
+        self.responseValues = array.array('d', responseValues)
+        self.netNumbers = array.array('d', netNumbers)
+        self.netLabels = tuple([intern(str(label)) for label in netLabels])
+        self.nettingName = intern(str(nettingName))
+        self.missingCodes = tuple(missingCodes)
+
+    # pickled with the arrays as raw bytes, for the model cache
+    def __getstate__(self):
+        return (self.number, self.variableName, self.dashboardLabel, self.responseValues.tostring(), \
+                self.netNumbers.tostring(), self.netLabels, self.nettingName, self.missingCodes)
+
+    def __setstate__(self, state):
+        number, variableName, dashboardLabel, responseValues, netNumbers, netLabels, nettingName, \
+                                                                          missingCodes = state
+        self.__init__(number, variableName, dashboardLabel, array.array('d', responseValues), \
+                      array.array('d', netNumbers), netLabels, nettingName, missingCodes)
+
+# Spec layout versions. Each revision of the dashboard spec form is described by
+# the text its DashboardSpec sheet is stamped with, the sheets this script reads,
+# and the 0-based NettingSpec column each field of a qbox is found in. A new
+# revision only needs an entry in SPEC_LAYOUTS; entries are tried in order.
+APRIL_2013_LAYOUT = {
+    "name": "5 April 2013",
+    "versionSheet": "dashboard",
+    "versionRow": 0,
+    "versionText": "Updated 5 April",
+    "sheets": {"dashboard": "DashboardSpec-->CS", "dp": "DPSpec-->DP", "netting": "NettingSpec-->"},
+    # a qbox header row has "Yes" in the flag column
+    "headerFlag": "Yes",
+    "columns": {"flag": 1, "responseValue": 1, "variableName": 2, "dashboardLabel": 4,
+                "netNumber": 4, "netLabel": 5},
+    # DashboardSpec fields, each found in the first filled cell to the right of its label
+    "dashboardFields": {"study": "Study", "magicKey": "Magic Key", "magicValue": "Magic Value",
+                        "movieIdVariable": "Movie ID Variable", "pidVariable": "Participant ID Variable"},
+    # DPSpec video table, found by the heading of its name column; the other
+    # columns are optional and found by their headings in the same row
+    "videoColumns": {"name": "Video Name", "video": "Video", "duration": "Duration",
+                     "autoViewSequence": "View Sequence"},
+}
+MARCH_2013_LAYOUT = dict(APRIL_2013_LAYOUT, name="15 March 2013", versionText="Updated 15 March")
+
+SPEC_LAYOUTS = [APRIL_2013_LAYOUT, MARCH_2013_LAYOUT]
+
+# A spec layout compiled for the extractors: the sheet names, the column of each
+# field, the set of NettingSpec columns that has to be loaded for them, and the
+# header labels to look for, keyed by their lower case ASCII form.
+class ExtractionPlan(object):
+
+    __slots__ = ('name', 'sheets', 'versionSheet', 'versionRow', 'versionText', 'headerFlag', \
+                 'flag', 'responseValue', 'variableName', 'dashboardLabel', 'netNumber', 'netLabel', \
+                 'columns', 'dashboardFields', 'videoColumns')
+
+    def __init__(self, layout):
+        self.name = layout["name"]
+        self.sheets = dict(layout["sheets"])
+        self.versionSheet = self.sheets[layout["versionSheet"]]
+        self.versionRow = layout["versionRow"]
+        self.versionText = layout["versionText"]
+        self.headerFlag = layout["headerFlag"]
+
+        columns = layout["columns"]
+        self.flag = columns["flag"]
+        self.responseValue = columns["responseValue"]
+        self.variableName = columns["variableName"]
+        self.dashboardLabel = columns["dashboardLabel"]
+        self.netNumber = columns["netNumber"]
+        self.netLabel = columns["netLabel"]
+        self.columns = tuple(sorted(set(columns.values())))
+
+        self.dashboardFields = dict((label.lower(), field) for field, label in layout["dashboardFields"].items())
+        self.videoColumns = dict((label.lower(), field) for field, label in layout["videoColumns"].items())
+
+    # Input: the values of the plan's version row
+    # Output: whether one of its cells carries this layout's version stamp
+    def matches(self, versionRowValues):
+        for value in versionRowValues:
+            if isinstance(value, basestring) and self.versionText in value:
+                return True
+        return False
+
+EXTRACTION_PLANS = [ExtractionPlan(layout) for layout in SPEC_LAYOUTS]
+# the plan used when none is given, for callers working on a worksheet directly
+DEFAULT_PLAN = EXTRACTION_PLANS[0]
+
+# Imports the data from every qbox
+# Input: an open worksheet (or ColumnSnapshot), a list of qbox (header, footer) row pairs,
+#        optionally the question number and netting name of each qbox, and the
+#        ExtractionPlan of the spec's layout
+# Output: a list holding the imported data of each question
+def import_qboxes(worksheet, qboxDimensions, questionNumbers=None, nettingNames=None, plan=DEFAULT_PLAN):
+
+    return list(iter_qboxes(worksheet, qboxDimensions, questionNumbers, nettingNames, plan=plan))
+
+# Imports the data from one qbox at a time, so callers can emit each question
+# as soon as it has been extracted
+# Input: an open worksheet (or ColumnSnapshot), a list of qbox (header, footer) row pairs,
+#        optionally the question number of each qbox (1, 2, 3... by default),
+#        optionally the netting name of each qbox (assigned in import order by default),
+#        optionally a dict of variable name -> missing-value codes in the data,
+#        and the ExtractionPlan of the spec's layout
+# Output: yields the imported data of each question in turn
+def iter_qboxes(worksheet, qboxDimensions, questionNumbers=None, nettingNames=None, missingCodes=None, \
+                                                                                plan=DEFAULT_PLAN):
+
+    totalQuestions = str(len(qboxDimensions))
+    if questionNumbers is None:
+        questionNumbers = range(1, len(qboxDimensions) + 1)
+    customNettings = {}
+
+    if isinstance(worksheet, ColumnSnapshot):
+        read_response_values = snapshot_response_values
+        read_net_numbers = snapshot_net_numbers
+        read_net_labels = snapshot_net_labels
+    else:
+        read_response_values = get_response_values
+        read_net_numbers = get_net_numbers
+        read_net_labels = get_net_labels
 
-# TODO: Remove after testing
-PRINT_DEBUG = False
-PRINT_IMPORT = False
-PRINT_WARNINGS = False
-
-def import_qboxes(worksheet, qboxDimensions):
-
-    qboxHeaders, qboxFooters = zip(*qboxDimensions)
-
-    questionNumber = 0
-    totalQuestions = str(len(qboxHeaders))
-    questionData = []
+    # the values are only joined for the log when it will be written
+    debug = logger.isEnabledFor(logging.DEBUG)
 
     # for each question:
-    for i, headerRow in enumerate(qboxHeaders):
-        footerRow = qboxFooters[i]
-        
-        question = []
-        questionNumber += 1
+    for i, (questionNumber, (headerRow, footerRow)) in enumerate(zip(questionNumbers, qboxDimensions)):
 
-        if PRINT_IMPORT:
-            print "question #: " + str(questionNumber) + " of " + totalQuestions + "\r"
+        logger.debug("question #: %s of %s", questionNumber, totalQuestions)
 
         # import the variable name
-        variableName = get_variable_name(worksheet, headerRow)
+        variableName = get_variable_name(worksheet, headerRow, plan)
 
         # import the Dashboard Label
-        dashboardLabel = get_dashboard_label(worksheet, headerRow)
+        dashboardLabel = get_dashboard_label(worksheet, headerRow, plan)
 
         # import that question's response values
-        responseValues = get_response_values(worksheet, headerRow, footerRow)
-
-        question.append(questionNumber)
-        question.append(variableName)
-        question.append(dashboardLabel)
-        question.append(responseValues)
+        responseValues = read_response_values(worksheet, headerRow, footerRow, plan)
 
-        if PRINT_IMPORT:
-            print "Response Values:\r"
-            for val in responseValues:
-                print val
+        if debug:
+            logger.debug("Response Values: %s", ", ".join(map(str, responseValues)))
 
         # import that question's net numbers
-        netNumbers = get_net_numbers(worksheet, headerRow, footerRow)
-
-        if PRINT_IMPORT:
-            print "Net Numbers:\r"
-            for val in netNumbers:
-                print val
+        netNumbers = read_net_numbers(worksheet, headerRow, footerRow, plan)
 
-        question.append(netNumbers)
+        if debug:
+            logger.debug("Net Numbers: %s", ", ".join(map(str, netNumbers)))
 
         # check amount of response values == amount of net numbers
         if len(netNumbers) != len(responseValues):
-            print "the number of reponse value entries does not match the number of net number entries for question " + str(questionNumber)
-            print "please check this question in the dashboard specification form and then try this program again."
-            sys.exit(0)                              # TODO: replace with proper exception handling
+            raise QboxImportError("the number of reponse value entries does not match the number of net number " + \
+                                  "entries for question " + str(questionNumber) + "\n" + \
+                                  "please check this question in the dashboard specification form and then " + \
+                                  "try this program again.")
 
         # import the question's dashboard net labels.
-        netLabels = get_net_labels(worksheet, headerRow, footerRow)
+        netLabels = read_net_labels(worksheet, headerRow, footerRow, plan)
 
-        question.append(netLabels)
-
-        if PRINT_IMPORT:
-            print "Net Labels:\r"
-            for string in netLabels:
-                print string
+        if debug:
+            logger.debug("Net Labels: %s", ", ".join(netLabels))
 
         # check amount of net labels == amount of netting categories
         if len(netLabels) != max(netNumbers):
-            print "There are more unique net labels than there are unique net numbers!"
-            print "please check question " + str(questionNumber) + " in the dashboard specification form then try this program again."
-            sys.exit(0)                              # TODO: replace with proper exception handling
-
-        # get custom netting name for this question
-        nettingName = get_netting_name(responseValues, netNumbers)
-        if nettingName == "none":
-            nettingName = str("Question" + str(questionNumber) + "Netting")
+            raise QboxImportError("There are more unique net labels than there are unique net numbers!\n" + \
+                                  "please check question " + str(questionNumber) + " in the dashboard " + \
+                                  "specification form then try this program again.")
 
-        question.append(nettingName)
+        # missing-value codes the desparsed data uses for this question
+        codes = []
+        if missingCodes:
+            codes = sorted(missingCodes.get(variableName, []))
 
-        if PRINT_IMPORT:
-            print "Netting Name: " + nettingName + "\r"
+        # get custom netting name for this question
+        if nettingNames is not None:
+            nettingName = nettingNames[i]
+        else:
+            nettingName = assign_netting_name(responseValues, netNumbers, questionNumber, customNettings, codes)
 
-        questionData.append(question)
+        logger.debug("Netting Name: %s", nettingName)
 
-    return questionData
+        yield Question(questionNumber, variableName, dashboardLabel, responseValues, netNumbers, \
+                                                              netLabels, nettingName, codes)
 
-def get_dashboard_label(worksheet, headerRow):
+def get_dashboard_label(worksheet, headerRow, plan=DEFAULT_PLAN):
 
     dashboardLabel = ""
 
-    if (worksheet.cell_type(headerRow, 4) == 0):
-        print "found a blank dashboard label."
-        print "please ensure the dashboard label at row " + str(headerRow+1) + " exists and then try this program again."
-        sys.exit(0)                              # TODO: replace with proper exception handling
-    elif (worksheet.cell_type(headerRow, 4) == 1):
-            variableName = unicodedata.normalize('NFKD', worksheet.cell_value(headerRow, 4)).encode('ascii', 'ignore')
-    elif (worksheet.cell_type(headerRow, 4) == 2):
-        variableName = str(worksheet.cell_value(headerRow, 4))
+    if (worksheet.cell_type(headerRow, plan.dashboardLabel) == 0):
+        raise QboxImportError("found a blank dashboard label.\n" + \
+                              "please ensure the dashboard label at row " + str(headerRow+1) + " exists and then try this program again.")
+    elif (worksheet.cell_type(headerRow, plan.dashboardLabel) == 1):
+            variableName = ascii_text(worksheet.cell_value(headerRow, plan.dashboardLabel))
+    elif (worksheet.cell_type(headerRow, plan.dashboardLabel) == 2):
+        variableName = str(worksheet.cell_value(headerRow, plan.dashboardLabel))
     else:
-        print "could not read a dashboard label cell."
-        print "please ensure the dashboard label at row " + str(headerRow+1) + " exists and then try this program again."
-        sys.exit(0)                              # TODO: replace with proper exception handling
+        raise QboxImportError("could not read a dashboard label cell.\n" + \
+                              "please ensure the dashboard label at row " + str(headerRow+1) + " exists and then try this program again.")
 
     return variableName
 
-def get_variable_name(worksheet, headerRow):
+def get_variable_name(worksheet, headerRow, plan=DEFAULT_PLAN):
 
     variableName = ""
 
-    if (worksheet.cell_type(headerRow, 2) == 0):
-        print "found a blank variable name."
-        print "please ensure the variable name at row " + str(headerRow+1) + " exists and then try this program again."
-        sys.exit(0)                              # TODO: replace with proper exception handling
-    elif (worksheet.cell_type(headerRow, 2) == 1):
-            variableName = unicodedata.normalize('NFKD', worksheet.cell_value(headerRow, 2)).encode('ascii', 'ignore')
-    elif (worksheet.cell_type(headerRow, 2) == 2):
-        variableName = str(worksheet.cell_value(headerRow, 2))
+    if (worksheet.cell_type(headerRow, plan.variableName) == 0):
+        raise QboxImportError("found a blank variable name.\n" + \
+                              "please ensure the variable name at row " + str(headerRow+1) + " exists and then try this program again.")
+    elif (worksheet.cell_type(headerRow, plan.variableName) == 1):
+            variableName = ascii_text(worksheet.cell_value(headerRow, plan.variableName))
+    elif (worksheet.cell_type(headerRow, plan.variableName) == 2):
+        variableName = str(worksheet.cell_value(headerRow, plan.variableName))
     else:
-        print "could not read a variable name cell."
-        print "please ensure the question variable name at row " + str(headerRow+1) + " exists and then try this program again."
-        sys.exit(0)                              # TODO: replace with proper exception handling
+        raise QboxImportError("could not read a variable name cell.\n" + \
+                              "please ensure the question variable name at row " + str(headerRow+1) + " exists and then try this program again.")
 
     return variableName
     
 
+# Names the netting a question's net numbers describe
+# Input: the question's response values and net numbers
+# Output: "0" for no netting, the name of a built-in netting that maps the
+#         response values the same way, or "none" for a custom netting
 def get_netting_name(responseValues, netNumbers):
 
-    nettingName = "none"
-
     # No Netting
-    no_net = True
-    for i in range(0, len(netNumbers)):
-        if not netNumbers[i] == i+1:
-            no_net = False
-
-    # TopVersusRestUpTo10
-    tvrut10 = True
-    for i in range(1, len(netNumbers)):
-        if not netNumbers[i] == 2:
-            tvrut10 = False
-
-    # TopTwoVersusRestUpTo10
-    t2vrut10 = True
-    if (len(netNumbers) >= 3) and (netNumbers[0] == 1 and netNumbers[1] == 1):
-        for i in range(2, len(netNumbers)):
-            if not netNumbers[i] == 2:
-                t2vrut10 = False
-    else:
-        t2vrut10 = False
-
-    # SixToThree
-    stt = False
-    if len(netNumbers) == 6:
-        if netNumbers[0]==1 and netNumbers[1]==1 and netNumbers[2]==2 and netNumbers[3]==2 and netNumbers[4]==3 and netNumbers[5]==3:
-            stt = True
-
-
-    if no_net:
-        nettingName = "0"
-    elif tvrut10:
-        nettingName = "TopVersusRestUpTo10"
-    elif t2vrut10:
-        nettingName = "TopTwoVersusRestUpTo10"
-    elif stt:
-        nettingName = "SixToThree"
-
-    # TODO: Add Custom Netting Label Support for Pre-Existing Net Labels
-    # (Program is functional without this, but human readers of the .dcc.yaml file might get upset if this section is neglected for long)
+    if list(netNumbers) == range(1, len(netNumbers) + 1):
+        return "0"
+
+    return NETTING_INDEX.get(tuple(netNumbers), "none")
+
+# Names a question's netting, giving custom nettings a QuestionNNetting name.
+# Questions with identical custom nettings share the name of the first of them.
+# A question whose data uses missing-value codes (see scan_desparsed_csv) only
+# keeps a built-in netting that already maps those codes.
+# Input: the question's response values, net numbers and question number, a dict of
+#        the custom nettings named so far, which is updated, and the question's
+#        missing-value codes
+# Output: the netting name
+def assign_netting_name(responseValues, netNumbers, questionNumber, customNettings, missingCodes=()):
+
+    nettingName = get_netting_name(responseValues, netNumbers)
+    if missingCodes and nettingName != "none":
+        if nettingName == "0" or not set(missingCodes) <= BUILTIN_NETTING_CODES[nettingName]:
+            nettingName = "none"
+
+    if nettingName == "none":
+        nettingName = customNettings.setdefault((tuple(netNumbers), tuple(missingCodes)), \
+                                                str("Question" + str(questionNumber) + "Netting"))
 
     return nettingName
 
 # Input: a qbox header and footer
 # Output: a list of net labels for the specified question
-def get_net_labels(worksheet, headerRow, footerRow):
+def get_net_labels(worksheet, headerRow, footerRow, plan=DEFAULT_PLAN):
 
     netLabels = []
 
@@ -216,13 +469,12 @@ def get_net_labels(worksheet, headerRow, footerRow):
     # from netLabelRow to footer:
     for row in range(netLabelRow, footerRow):
 
-        if (worksheet.cell_type(row, 5) == 0):
-            print "found a blank net label entry."
-            print "please ensure the net label at row " + str(row+1) + " exists and then try this program again."
-            sys.exit(0)                              # TODO: replace with proper exception handling
-        elif (worksheet.cell_type(row, 5) == 1):
+        if (worksheet.cell_type(row, plan.netLabel) == 0):
+            raise QboxImportError("found a blank net label entry.\n" + \
+                                  "please ensure the net label at row " + str(row+1) + " exists and then try this program again.")
+        elif (worksheet.cell_type(row, plan.netLabel) == 1):
             # get candidate net label
-            label = unicodedata.normalize('NFKD', worksheet.cell_value(row, 5)).encode('ascii', 'ignore')
+            label = ascii_text(worksheet.cell_value(row, plan.netLabel))
             
             # first net label is automatically accepted
             if len(netLabels)==0:
@@ -231,23 +483,21 @@ def get_net_labels(worksheet, headerRow, footerRow):
             else:
                 # all other net labels are only accepted if they differ from the netLabel before it
                 if prev_label == "":
-                    print "logic error in get_net_labels function."
-                    sys.exit(0)                      # TODO: replace with proper exception handling
+                    raise QboxImportError("logic error in get_net_labels function.")
                 elif label != prev_label:
                     netLabels.append(label)
                     prev_label = label
                 else:
                     prev_label = label
         else:
-            print "could not read a net label cell."
-            print "please ensure the net label at row " + str(row+1) + " makes sense and then try this program again."
-            sys.exit(0)                              # TODO: replace with proper exception handling
+            raise QboxImportError("could not read a net label cell.\n" + \
+                                  "please ensure the net label at row " + str(row+1) + " makes sense and then try this program again.")
 
     return netLabels
 
 # Input: a qbox header and footer
 # Output: a list of net numbers for the specified question
-def get_net_numbers(worksheet, headerRow, footerRow):
+def get_net_numbers(worksheet, headerRow, footerRow, plan=DEFAULT_PLAN):
 
     netNumbers = []
 
@@ -257,28 +507,25 @@ def get_net_numbers(worksheet, headerRow, footerRow):
     # from netNumberRow to footer:
     for row in range(netNumberRow, footerRow):
 
-        if (worksheet.cell_type(row, 4) == 0):
-            print "found a blank net number entry."
-            print "please ensure the net number at row " + str(row+1) + " exists and then try this program again."
-            sys.exit(0)                              # TODO: replace with proper exception handling
-        elif (worksheet.cell_type(row, 4) == 1):
-            print "found a net number entry which was not a number: " + \
-            unicodedata.normalize('NFKD', worksheet.cell_value(row, 4)).encode('ascii', 'ignore')
-            print "please ensure the net number at row " + str(row+1) + " is a number and then try this program again."
-            sys.exit(0)                              # TODO: replace with proper exception handling
-        elif (worksheet.cell_type(row, 4) == 2):
-            val = worksheet.cell_value(row, 4)
+        if (worksheet.cell_type(row, plan.netNumber) == 0):
+            raise QboxImportError("found a blank net number entry.\n" + \
+                                  "please ensure the net number at row " + str(row+1) + " exists and then try this program again.")
+        elif (worksheet.cell_type(row, plan.netNumber) == 1):
+            raise QboxImportError("found a net number entry which was not a number: " + \
+                                  ascii_text(worksheet.cell_value(row, plan.netNumber)) + "\n" + \
+                                  "please ensure the net number at row " + str(row+1) + " is a number and then try this program again.")
+        elif (worksheet.cell_type(row, plan.netNumber) == 2):
+            val = worksheet.cell_value(row, plan.netNumber)
             netNumbers.append(val)
         else:
-            print "could not read a net number cell."
-            print "please ensure the net number at row " + str(row+1) + " exists and then try this program again."
-            sys.exit(0)                              # TODO: replace with proper exception handling
+            raise QboxImportError("could not read a net number cell.\n" + \
+                                  "please ensure the net number at row " + str(row+1) + " exists and then try this program again.")
 
     return netNumbers
 
 # Input: a qbox header and footer
 # Output: a list of response values for the specified question
-def get_response_values(worksheet, headerRow, footerRow):
+def get_response_values(worksheet, headerRow, footerRow, plan=DEFAULT_PLAN):
 
     responseValues = []
     expected_value = 1.0
@@ -289,93 +536,89 @@ def get_response_values(worksheet, headerRow, footerRow):
     # from responseValueRow to footer:
     for row in range(responseValueRow, footerRow):
 
-        if (worksheet.cell_type(row,1) == 0):
-            if PRINT_WARNINGS:
-                print "found a blank cell where a response value entry was expected."
-                print "(expected response value of " + str(expected_value) + " at row #" + str(row+1) + ")\r"
-                print "adding expected reponse value instead."
+        if (worksheet.cell_type(row, plan.responseValue) == 0):
+            logger.info("found a blank cell where a response value entry was expected.")
+            logger.info("(expected response value of %s at row #%s)", expected_value, row+1)
+            logger.info("adding expected reponse value instead.")
             responseValues.append(expected_value)
-        elif (worksheet.cell_type(row, 1) == 1):
-            if PRINT_WARNINGS:
-                print "found a response value entry which was not a number: " + \
-                unicodedata.normalize('NFKD', worksheet.cell_value(row, 1)).encode('ascii', 'ignore')
-                print "(expected response value of " + str(expected_value) + " at row #" + str(row+1) + ")\r"
-                print "adding expected response value instead."
+        elif (worksheet.cell_type(row, plan.responseValue) == 1):
+            logger.info("found a response value entry which was not a number: %s", \
+                        ascii_text(worksheet.cell_value(row, plan.responseValue)))
+            logger.info("(expected response value of %s at row #%s)", expected_value, row+1)
+            logger.info("adding expected response value instead.")
             responseValues.append(expected_value)
-        elif (worksheet.cell_type(row, 1) == 2):
-            val = worksheet.cell_value(row, 1)
+        elif (worksheet.cell_type(row, plan.responseValue) == 2):
+            val = worksheet.cell_value(row, plan.responseValue)
             if val != expected_value:
-                if PRINT_WARNINGS:
-                    print "response value expected was " + str(expected_value) + " and the response value received was " + str(val)
+                logger.info("response value expected was %s and the response value received was %s", \
+                            expected_value, val)
                 if val == (expected_value - 1):
-                    if PRINT_WARNINGS:
-                        print "response values for this question appear to start at 0 instead of 1."
-                        print "this program will perform as if these values start at 1."
+                    logger.info("response values for this question appear to start at 0 instead of 1.")
+                    logger.info("this program will perform as if these values start at 1.")
                     responseValues.append(expected_value)
                 else:
-                    if PRINT_WARNINGS:
-                        "using expected response value instead."
+                    logger.info("using expected response value instead.")
                     responseValues.append(expected_value)
             else:
                 responseValues.append(expected_value)
         else:
-            print "could not read a response value cell."
-            print "(expected response value of " + str(expected_value) + " at row #" + str(row+1) + ")\r"
-            print "adding expected reponse value instead."
+            logger.warning("could not read a response value cell.")
+            logger.warning("(expected response value of %s at row #%s)", expected_value, row+1)
+            logger.warning("adding expected reponse value instead.")
             responseValues.append(expected_value)
 
         expected_value += 1.0
 
     return responseValues
 
-# Prints the questions within each qbox header given as input
-def print_qbox_questions(worksheet, qboxHeaderRows):
+# Logs the questions within each qbox header given as input, at DEBUG
+def print_qbox_questions(worksheet, qboxHeaderRows, plan=DEFAULT_PLAN):
 
     for qbox_header_row in qboxHeaderRows:
-        print "    " + worksheet.cell_value(qbox_header_row, 2) + ":\r"
-        print "        name: \"" + worksheet.cell_value(qbox_header_row, 4) + "\"\r"
+        logger.debug("    %s:", worksheet.cell_value(qbox_header_row, plan.variableName))
+        logger.debug("        name: \"%s\"", worksheet.cell_value(qbox_header_row, plan.dashboardLabel))
 
     return 0
 
-# A useful debugging function which prints qbox data to the screen
-def print_qboxes(worksheet, qboxDimensions):
+# A useful debugging function which logs qbox data at DEBUG
+def print_qboxes(worksheet, qboxDimensions, plan=DEFAULT_PLAN):
 
     qbox_headers, qbox_footers = zip(*qboxDimensions)
 
     for i, qbox_header_row in enumerate(qbox_headers):
         qbox_footer_row = qbox_footers[i]    
        
-        print "\r################################"
-        print "QBOX " + str(i+1) + ":"
-        print "Dimensions: (" + str(qbox_header_row) + ", " + str(2) + ") -- (" + str(qbox_footer_row) + ", " + str(5) + ")"
+        logger.debug("################################")
+        logger.debug("QBOX %s:", i+1)
+        logger.debug("Dimensions: (%s, %s) -- (%s, %s)", qbox_header_row, plan.variableName, qbox_footer_row, plan.netLabel)
 
         for curr_row_num in range(qbox_header_row-1, qbox_footer_row+1):
             if curr_row_num == qbox_header_row-1:
-                print "\r[Title Row " + str(curr_row_num+1) + "]"
+                logger.debug("[Title Row %s]", curr_row_num+1)
             elif curr_row_num == qbox_header_row:
-                print "\r[Key Row " + str(curr_row_num+1) + "]"
+                logger.debug("[Key Row %s]", curr_row_num+1)
             else:
-                print "\r[Row " + str(curr_row_num+1) + "]"
+                logger.debug("[Row %s]", curr_row_num+1)
 
             qbox_row_values = worksheet.row_values(curr_row_num)
 
-            for curr_col_num in range(1,6): 
+            for curr_col_num in range(plan.columns[0], plan.columns[-1]+1):
 
                 output = "cell was not read"
                 if (worksheet.cell_type(curr_row_num, curr_col_num) == 1):
-                    output = unicodedata.normalize('NFKD', worksheet.cell_value(curr_row_num, curr_col_num)).encode('ascii', 'ignore')
+                    output = ascii_text(worksheet.cell_value(curr_row_num, curr_col_num))
                 elif (worksheet.cell_type(curr_row_num, curr_col_num) == 0):
-                    output = "(Blank)\r" 
+                    output = "(Blank)" 
                 else:
                     output = str(worksheet.cell_value(curr_row_num, curr_col_num)) + "\t" 
 
-                print "[Col " + xlrd.colname(curr_col_num) + "]\t\t" + output
+                logger.debug("[Col %s]\t\t%s", xlrd.colname(curr_col_num), output)
     return 0
 
 # Determines the initial row of each qbox in the worksheet
 # Input: an open worksheet
 # Output: a list containing the initial row number of each qbox
-def locate_qboxHeaderRows(worksheet):
+def locate_qboxHeaderRows(worksheet, plan=DEFAULT_PLAN):
     qboxHeaderRows = []    
 
     questions_to_omit = ["ID", "", "Active_Positive", "Passive_Positive", "Active_Negative", "Passive_Negative"]
@@ -386,9 +629,9 @@ def locate_qboxHeaderRows(worksheet):
     curr_row = -1
     while curr_row < num_rows:
         curr_row += 1
-        cell_value = worksheet.cell_value(curr_row, 1)
-        if cell_value == "Yes":
-            if worksheet.cell_value(curr_row, 2).strip() not in questions_to_omit:
+        cell_value = worksheet.cell_value(curr_row, plan.flag)
+        if cell_value == plan.headerFlag:
+            if unicode(worksheet.cell_value(curr_row, plan.variableName)).strip() not in questions_to_omit:
                 qboxHeaderRows.append(curr_row)
 
     return qboxHeaderRows
@@ -396,13 +639,13 @@ def locate_qboxHeaderRows(worksheet):
 # Determines the ending row of each qbox in the worksheet
 # Input: an open worksheet, a list of qbox header row numbers
 # Output: a list of tuples containing the number of the first and last row of each qbox
-def locate_qbox_footers(worksheet, qboxHeaderRows):
+def locate_qbox_footers(worksheet, qboxHeaderRows, plan=DEFAULT_PLAN):
     
     qbox_ending_rows = []
 
     for qbox_header_row in qboxHeaderRows:
         valid_net_row = qbox_header_row + 2
-        while (worksheet.cell_type(valid_net_row, 4) == 2):
+        while (worksheet.cell_type(valid_net_row, plan.netNumber) == 2):
             valid_net_row += 1
         qbox_ending_rows.append(valid_net_row)
 
@@ -436,20 +679,292 @@ def determine_netting(worksheet, qboxDimensions):
         netting_tuples.append(zip(response_value, netting_category))
 
     return netting_tuples
+# A columnar copy of the NettingSpec columns the qbox extractors read.
+# Each column's cell types and values are captured once as plain lists, so header
+# detection, footer detection and per-qbox slicing run over the lists instead of
+# through one worksheet.cell_type/cell_value call per cell. It answers cell_type
+# and cell_value for the captured columns, so the get_* functions can still be
+# run against it to report errors.
+class ColumnSnapshot(object):
+
+    def __init__(self, worksheet, columns=DEFAULT_PLAN.columns):
+        self.nrows = worksheet.nrows
+        self.ncols = worksheet.ncols
+        self.types = {}
+        self.values = {}
+
+        for col in columns:
+            if col < worksheet.ncols:
+                self.types[col] = worksheet.col_types(col)
+                self.values[col] = worksheet.col_values(col)
+            else:
+                self.types[col] = [xlrd.XL_CELL_EMPTY] * self.nrows
+                self.values[col] = [u''] * self.nrows
+
+    def cell_type(self, row, col):
+        return self.types[col][row]
+
+    def cell_value(self, row, col):
+        return self.values[col][row]
+
+# Snapshot equivalent of locate_qboxHeaderRows
+# Input: a ColumnSnapshot of the NettingSpec worksheet
+# Output: a list containing the initial row number of each qbox
+def snapshot_qboxHeaderRows(snapshot, plan=DEFAULT_PLAN):
+
+    questions_to_omit = ["ID", "", "Active_Positive", "Passive_Positive", "Active_Negative", "Passive_Negative"]
+
+    variableNames = snapshot.values[plan.variableName]
+
+    return [row for row, flag in enumerate(snapshot.values[plan.flag]) \
+                if flag == plan.headerFlag and unicode(variableNames[row]).strip() not in questions_to_omit]
+
+# Snapshot equivalent of locate_qbox_footers: each footer is the first row at or
+# after header+2 whose column 4 cell is not a number. All of them are found with
+# one search over the column.
+# Input: a ColumnSnapshot, a list of qbox header row numbers
+# Output: a list of tuples containing the number of the first and last row of each qbox
+def snapshot_qbox_footers(snapshot, qboxHeaderRows, plan=DEFAULT_PLAN):
+
+    if not qboxHeaderRows:
+        return []
+
+    types = numpy.array(snapshot.types[plan.netNumber], dtype=numpy.int8)
+    notNumbers = numpy.flatnonzero(types != xlrd.XL_CELL_NUMBER)
+    # a qbox running into the last row ends at the bottom of the sheet
+    notNumbers = numpy.append(notNumbers, snapshot.nrows)
+
+    starts = numpy.array(qboxHeaderRows) + 2
+    qbox_ending_rows = notNumbers[numpy.searchsorted(notNumbers, starts)]
+
+    return zip(qboxHeaderRows, qbox_ending_rows.tolist())
+
+# Snapshot equivalent of get_response_values. Response values are always
+# renumbered from 1, so only the messages about them need the individual cells.
+def snapshot_response_values(snapshot, headerRow, footerRow, plan=DEFAULT_PLAN):
+
+    if logger.isEnabledFor(logging.INFO):
+        return get_response_values(snapshot, headerRow, footerRow, plan)
+
+    return [float(val) for val in range(1, footerRow - headerRow - 1)]
+
+# Snapshot equivalent of get_net_numbers. Every row up to the footer holds a
+# number by construction, so the slice is taken as it is.
+def snapshot_net_numbers(snapshot, headerRow, footerRow, plan=DEFAULT_PLAN):
+
+    types = snapshot.types[plan.netNumber][headerRow+2:footerRow]
+    if types.count(xlrd.XL_CELL_NUMBER) != len(types):
+        return get_net_numbers(snapshot, headerRow, footerRow, plan)
+
+    return snapshot.values[plan.netNumber][headerRow+2:footerRow]
+
+# Snapshot equivalent of get_net_labels. Falls back to get_net_labels, which
+# reports the offending cell, whenever the slice holds anything but text.
+def snapshot_net_labels(snapshot, headerRow, footerRow, plan=DEFAULT_PLAN):
+
+    types = snapshot.types[plan.netLabel][headerRow+2:footerRow]
+    if types.count(xlrd.XL_CELL_TEXT) != len(types):
+        return get_net_labels(snapshot, headerRow, footerRow, plan)
+
+    labels = [ascii_text(label) for label in snapshot.values[plan.netLabel][headerRow+2:footerRow]]
+    if "" in labels:
+        return get_net_labels(snapshot, headerRow, footerRow, plan)
+
+    # keep each label that differs from the one before it
+    return [label for i, label in enumerate(labels) if i == 0 or label != labels[i-1]]
+
+# Spec validation. Every qbox is checked in one pass over the columns the
+# extractors read, and each problem they would stop at is collected along with
+# the cell it was found in, so that a spec can be fixed in one go.
+
+# Output: the cell types and values of one column of a worksheet or ColumnSnapshot
+def read_validation_column(source, col):
+
+    if isinstance(source, ColumnSnapshot):
+        return source.types[col], source.values[col]
+    if col >= source.ncols:
+        return [xlrd.XL_CELL_EMPTY] * source.nrows, [u''] * source.nrows
 
-def printQuestions(questionData):
+    return source.col_types(col), source.col_values(col)
 
-    print "questions:"
+# Input: a worksheet or ColumnSnapshot, a list of qbox header and footer rows, and the
+#        ExtractionPlan of the spec's layout
+# Output: a list of (row, column, message) tuples, one per problem found
+def validate_qboxes(source, qboxDimensions, plan=DEFAULT_PLAN):
 
+    errors = []
+
+    types = {}
+    values = {}
+    for col in set((plan.variableName, plan.dashboardLabel, plan.netNumber, plan.netLabel)):
+        types[col], values[col] = read_validation_column(source, col)
+
+    for i, (headerRow, footerRow) in enumerate(qboxDimensions):
+        question = " (question " + str(i+1) + ")"
+
+        # variable name and dashboard label
+        for col, field in ((plan.variableName, "variable name"), (plan.dashboardLabel, "dashboard label")):
+            if types[col][headerRow] == xlrd.XL_CELL_EMPTY:
+                errors.append((headerRow, col, "blank " + field + question))
+            elif types[col][headerRow] not in (xlrd.XL_CELL_TEXT, xlrd.XL_CELL_NUMBER):
+                errors.append((headerRow, col, "could not read the " + field + " cell" + question))
+
+        # the footer is the first row without a net number, so every row before it has one
+        if footerRow <= headerRow + 2:
+            errors.append((headerRow + 2, plan.netNumber, "no net numbers found" + question))
+            continue
+        maxNetNumber = max(values[plan.netNumber][row] for row in range(headerRow + 2, footerRow))
+
+        # net labels, counted the way get_net_labels counts them
+        labelCount = 0
+        labelErrors = len(errors)
+        previousLabel = None
+        for row in range(headerRow + 2, footerRow):
+            if types[plan.netLabel][row] == xlrd.XL_CELL_EMPTY:
+                errors.append((row, plan.netLabel, "blank net label" + question))
+            elif types[plan.netLabel][row] != xlrd.XL_CELL_TEXT:
+                errors.append((row, plan.netLabel, "could not read the net label cell" + question))
+            else:
+                label = ascii_text(values[plan.netLabel][row])
+                if label == "" and row < footerRow - 1:
+                    errors.append((row, plan.netLabel, "net label has no ASCII characters" + question))
+                elif label != previousLabel:
+                    labelCount += 1
+                previousLabel = label
+
+        if len(errors) == labelErrors and labelCount != maxNetNumber:
+            errors.append((headerRow + 2, plan.netLabel, str(labelCount) + " net labels found for net numbers up to " + \
+                                             str(int(maxNetNumber)) + question))
+
+    return errors
+
+# Prints each validation error with the NettingSpec cell it was found in
+def format_spec_errors(errors, plan=DEFAULT_PLAN):
+
+    lines = []
+    for row, col, message in sorted(errors):
+        lines.append("validation error: " + plan.sheets["netting"] + "!" + xlrd.cellname(row, col) + ": " + message)
+
+    lines.append(str(len(errors)) + " errors found; please correct the dashboard specification form " + \
+                                                                  "and then try this program again.")
+    return "\n".join(lines)
+
+# Model validation. The imported questions are checked in memory before they are
+# written, for the mistakes which would make the .dcc.yaml inconsistent: a netted
+# name which resolves to no netting, a netting without an entry for one of the
+# question's response values, a net number with no answer code, and a variable
+# name used twice. Custom nettings are defined by the first question using their
+# name, as write_spec emits them. Most questions of a spec share a handful of
+# response value and net number patterns, so each pattern is only checked once.
+class SpecModelCheck(object):
+
+    def __init__(self):
+        self.variableNames = set()
+        self.nettingCodes = dict(BUILTIN_NETTING_CODES)
+        self.netNumberErrors = {}
+        self.responseCodes = {}
+
+    # Output: a list of messages, one per problem found with the question
+    def check(self, question):
+
+        errors = []
+
+        if question.variableName in self.variableNames:
+            errors.append("variable name " + question.variableName + " is used by an earlier question")
+        self.variableNames.add(question.variableName)
+
+        # answer codes run 1.0, 2.0, ... one per net label
+        pattern = (question.netNumbers.tostring(), len(question.netLabels))
+        if pattern not in self.netNumberErrors:
+            self.netNumberErrors[pattern] = self.check_net_numbers(question.netNumbers, len(question.netLabels))
+        errors.extend(self.netNumberErrors[pattern])
+
+        if len(question.responseValues) != len(question.netNumbers):
+            errors.append(str(len(question.responseValues)) + " response values for " + \
+                                                 str(len(question.netNumbers)) + " net numbers")
+        pattern = question.responseValues.tostring()
+        if pattern not in self.responseCodes:
+            self.responseCodes[pattern] = self.check_response_values(question.responseValues)
+        codes, codeErrors = self.responseCodes[pattern]
+        errors.extend(codeErrors)
+        if question.missingCodes:
+            codes = codes | frozenset(question.missingCodes)
+
+        nettingName = question.nettingName
+        if nettingName == "0":
+            pass
+        elif nettingName in ("", "none"):
+            errors.append("netted name does not resolve to a netting")
+        elif nettingName in self.nettingCodes:
+            missing = codes - self.nettingCodes[nettingName]
+            if missing:
+                errors.append("netting " + nettingName + " has no entry for response values " + \
+                                                         ", ".join(sorted(missing, key=float)))
+        else:
+            self.nettingCodes[nettingName] = codes
+
+        return errors
+
+    # Output: a list of messages about net numbers that have no answer code
+    def check_net_numbers(self, netNumbers, answerCount):
+
+        if not answerCount:
+            return ["no answers"]
+        for netNumber in netNumbers:
+            if netNumber != int(netNumber) or not 1 <= netNumber <= answerCount:
+                return ["net number " + str(netNumber) + " has no answer code (codes run 1.0 to " + \
+                                                           str(float(answerCount)) + ")"]
+        return []
+
+    # Output: the customNetting keys of the response values, and a list of messages
+    #         about values that cannot be keys
+    def check_response_values(self, responseValues):
+
+        codes = [str(int(value)) for value in responseValues if value == int(value)]
+        if len(codes) != len(responseValues):
+            return frozenset(codes), ["response values which are not whole numbers"]
+        if len(set(codes)) != len(codes):
+            return frozenset(codes), ["response values which are not unique"]
+        return frozenset(codes), []
+
+# Output: the number and variable name of a question, for model validation errors
+def question_reference(question):
+
+    return "question " + str(question.number) + " (" + question.variableName + ")"
+
+# Checks every imported question before any of them is written; raises a
+# SpecModelError listing the errors if there are any
+# Input: a list of imported questions
+def check_spec_model(questionData):
+
+    check = SpecModelCheck()
+    errors = []
     for question in questionData:
-        t_variableName = question[1]
-        t_dashboardLabel = question[2]
-        t_nettingName = question[6]
-        print "    " + str(t_variableName) + ":"
-        print "        name: \"" + str(t_dashboardLabel) + "\""
-        print "        netted: " + str(t_nettingName) + ""
-
-    print """
+        errors.extend([question_reference(question) + ": " + message for message in check.check(question)])
+
+    if errors:
+        raise SpecModelError(errors)
+
+# Passes on imported questions one at a time, checking each before it is written
+# Output: a generator of the questions; raises a SpecModelError at the first
+#         question with errors
+def checked_questions(questions):
+
+    check = SpecModelCheck()
+    for question in questions:
+        errors = check.check(question)
+        if errors:
+            raise SpecModelError([question_reference(question) + ": " + message for message in errors])
+        yield question
+
+def format_model_errors(errors):
+
+    lines = ["validation error: " + message for message in errors]
+    lines.append(str(len(errors)) + " errors found in the generated spec; please correct the dashboard " + \
+                                                   "specification form and then try this program again.")
+    return "\n".join(lines)
+
+QUESTIONS_FOOTER = """
     Active_Positive:
         name: Active Positive
         netted: 0
@@ -465,24 +980,33 @@ def printQuestions(questionData):
     passiveActive:
         name: "Total Passive Active"
         type: pasact
+
 """
 
-def printAnswers(questionData):
+# Formats one question's entry in the questions section
+def format_question(question):
 
-    print "answers:"
+    t_variableName = question.variableName
+    t_dashboardLabel = question.dashboardLabel
+    t_nettingName = question.nettingName
+
+    return "    " + yaml_key(str(t_variableName)) + ":\n" + \
+           "        name: \"" + str(t_dashboardLabel) + "\"\n" + \
+           "        netted: " + str(t_nettingName) + "\n"
+
+def printQuestions(questionData, out=None):
+
+    if out is None:
+        out = sys.stdout
+
+    out.write("questions:\n")
 
     for question in questionData:
-        t_variableName = question[1]
-        t_netNumbers = question[4]
-        t_netLabels = question[5]
-        print "    " + str(t_variableName) + ":"
-        i=0
-        while i < len(t_netLabels):
-            print "        - name: \"" + str(t_netLabels[i]) + "\""
-            print "          code: " + str(float(i+1)) + ""
-            i += 1
+        out.write(format_question(question))
+
+    out.write(QUESTIONS_FOOTER)
 
-    print """    passiveActive:
+ANSWERS_FOOTER = """    passiveActive:
         - name: Active Positive
           code: 1.0
         - name: Active Negative
@@ -529,266 +1053,123 @@ def printAnswers(questionData):
           code: 1.0
         - name: "Not P- (0 Words) "
           code: 0.0
+
 """
 
-def printCustomNetting(questionData):
+# Output: the items of a question's answer list, as written in the answers section
+def format_answer_items(question):
+
+    lines = []
+    for i, label in enumerate(question.netLabels):
+        lines.append("        - name: \"" + str(label) + "\"\n" + \
+                     "          code: " + str(float(i+1)) + "\n")
+
+    return "".join(lines)
+
+# Formats one question's entry in the answers section
+def format_answers(question):
+
+    return "    " + yaml_key(str(question.variableName)) + ":\n" + format_answer_items(question)
+
+# Answer lists shared by several questions. The lists are written to a buffer as
+# the questions go by, and only their digests are kept; once every question has
+# been seen, the lists used more than once are copied out with an anchor on their
+# first use and an alias on every later one (a 5 point agree scale, say, is then
+# written once). Lists are matched on the text they are written as, so an alias
+# always stands for the same list.
+class AnswerAnchors(object):
+
+    def __init__(self):
+        self.entries = []
+        self.uses = collections.defaultdict(int)
+
+    # Writes the items of a question's answer list to buffer
+    def write(self, question, buffer):
+        items = format_answer_items(question)
+        digest = hashlib.sha1(items).digest()
+        self.entries.append((yaml_key(str(question.variableName)), digest, len(items)))
+        self.uses[digest] += 1
+        buffer.write(items)
+
+    # Copies the lists written to buffer (read from its current position) to out
+    # as the entries of the answers section
+    def copy(self, buffer, out):
+        names = {}
+        for variableName, digest, length in self.entries:
+            items = buffer.read(length)
+            if self.uses[digest] < 2 or not items:
+                out.write("    " + variableName + ":\n" + items)
+            elif digest in names:
+                out.write("    " + variableName + ": *" + names[digest] + "\n")
+            else:
+                names[digest] = "answers" + str(len(names) + 1)
+                out.write("    " + variableName + ": &" + names[digest] + "\n" + items)
 
-    netting_to_omit = ["0", "", "TopVersusRestUpTo10", "TopTwoVersusRestUpTo10", "SixToThree"]
+def printAnswers(questionData, out=None, answerAnchors=False):
 
-    print "customNetting:"
+    if out is None:
+        out = sys.stdout
 
-    for question in questionData:
-        t_responseValues = question[3]
-        t_netNumbers = question[4]
-        t_nettingName = question[6]
-
-        if t_nettingName not in netting_to_omit:
-            i=0
-            print "    " + str(t_nettingName) + ":"
-            while i < len(t_responseValues):
-                print "        \"" + str(int(t_responseValues[i])) + "\": " + str(int(t_netNumbers[i])) + ""
-                i += 1
-
-    print """
-    TwoOne:
-        "1": 1
-        "2": 1
-        "3": 2
-    0ish:
-        "1": 1
-        "2": 2
-        "3": 3
-        "4": 3
-        "5": 5
-        "6": 6
-        "7": 7
-    custom2:
-        "1": 1
-        "2": 2
-        "3": 3
-        "4": 4
-        "5": 5
-        "6": 6
-        "7": 6
-        "8": 6
-        "9": 6
-        "10": 6
-        "11": 6
-        "12": 6
-        "13": 6
-        "14": 6
-        "15": 6
-        "16": 6
-        "17": 6
-        "18": 6
-        "19": 6
-        "20": 6
-        "21": 6
-    custom3:
-        "1": 1
-        "2": 1
-        "3": 1
-        "4": 1
-        "5": 2
-        "6": 2
-    AllToOne:
-        "1": 1
-        "2": 1
-    EightVsFive:
-        "1": 1
-        "2": 1
-        "3": 1
-        "4": 1
-        "5": 1
-        "6": 1
-        "7": 1
-        "8": 1
-        "9": 2
-        "10": 2
-        "11": 2
-        "12": 2
-        "13": 2
-        "9999": 9999
-    Classe_Social:
-        "1": 1
-        "3": 2
-    OneThreeTwo:
-        "1": 1
-        "2": 2
-        "3": 2
-        "4": 2
-        "5": 3
-        "6": 3
-    SixToThree:
-        "1": 1
-        "2": 1
-        "3": 2
-        "4": 2
-        "5": 3
-        "6": 3
-        "9999": 9999
-    q37special:
-        "1": 1
-        "2": 1
-        "3": 2
-        "4": 3
-        "5": 1
-        "6": 4
-        "7": 5
-        "8": 6
-        "9": 7
-    top2VersusBottom3:
-        "1": 1
-        "2": 1
-        "3": 2
-        "4": 2
-        "5": 2
-    topVersusRestUpTo5:
-        "1": 1
-        "2": 2
-        "3": 2
-        "4": 2
-        "5": 2
-    TopVersusRestUpTo10:
-        "1": 1
-        "2": 2
-        "3": 2
-        "4": 2
-        "5": 2
-        "6": 2
-        "7": 2
-        "8": 2
-        "9": 2
-        "10": 2
-        "9999": 9999
-        "-99.99": 9999
-    TopTwoVersusRestUpTo10:
-        "1": 1
-        "2": 1
-        "3": 2
-        "4": 2
-        "5": 2
-        "6": 2
-        "7": 2
-        "8": 2
-        "9": 2
-        "10": 2
-        "9999": 9999
-        "-99.99": 9999
-    bottomVersusRestUpTo4:
-        "1": 1
-        "2": 1
-        "3": 1
-        "4": 2
-    qKc:
-        "1": 1
-        "2": 2
-        "3": 2
-        "4": 2
-        "5": 2
-        "6": 1
-        "7": 2
-        "8": 2
-        "9": 3
-        "9999": 9999
-    qKc2:
-        "1": 2
-        "2": 2
-        "3": 2
-        "4": 2
-        "5": 1
-        "6": 2
-        "7": 3
-        "9999": 9999
-    q37:
-        "1": 4
-        "2": 1
-        "3": 3
-        "4": 2
-        "5": 2
-        "6": 2
-        "7": 1
-        "8": 3
-        "9999": 9999
-    q53special:
-        "1": 1
-        "2": 1
-        "3": 1
-        "4": 2
-        "5": 3
-        "6": 4
-        "7": 1
-        "8": 5
-        "9": 6
-        "10": 6
-        "11": 6
-        "12": 6
-        "13": 6
-        "14": 6
-        "15": 6
-        "16": 6
-        "9999": 9999
-    Standard5To3:
-        "1": 1
-        "2": 1
-        "3": 2
-        "4": 3
-        "5": 3
-        "9999": 9999
-    standard4to2:
-        "1": 1
-        "2": 1
-        "3": 2
-        "4": 2
-        "9999": 9999
-    OneOneTwoThree:
-        "1": 1
-        "2": 1
-        "3": 2
-        "4": 3
-    OneOneTwo:
-        "1": 1
-        "2": 2
-        "3": 3
-        "4": 3
-        "9999": 9999
-    OneOneTwoTwoTwo:
-        "1": 1
-        "2": 1
-        "3": 2
-        "4": 2
-        "5": 2
-    TwoOneOne:
-        "1": 1
-        "2": 1
-        "3": 2
-        "4": 3
-    OneOneTwoTwoThree:
-        "1": 1
-        "2": 1
-        "3": 2
-        "4": 2
-        "5": 3
-    RE4:
-        "1": 1
-        "2": 2
-        "3": 3
-        "4": 3
-        "5": 3
-        "6": 3
-        "7": 3
-        "8": 3
-        "9": 3
-        "10": 3
-    Q14abc:
-        "1": 1
-        "2": 2
-        "3": 3
-        "4": 4
-        "5": 5
-        "6": 5
-        "7": 5
-AUs:
+    out.write("answers:\n")
+
+    if answerAnchors:
+        anchors = AnswerAnchors()
+        buffer = cStringIO.StringIO()
+        for question in questionData:
+            anchors.write(question, buffer)
+        buffer.seek(0)
+        anchors.copy(buffer, out)
+    else:
+        for question in questionData:
+            out.write(format_answers(question))
+
+    out.write(ANSWERS_FOOTER)
+
+# The built-in nettings, in the order they are written. A question whose net numbers
+# match one of them is netted by its name (see get_netting_name) instead of getting
+# a custom netting; each maps response value codes to net numbers.
+BUILTIN_NETTINGS = [
+    ("TwoOne", [("1", 1), ("2", 1), ("3", 2)]),
+    ("0ish", [("1", 1), ("2", 2), ("3", 3), ("4", 3), ("5", 5), ("6", 6), ("7", 7)]),
+    ("custom2", [("1", 1), ("2", 2), ("3", 3), ("4", 4), ("5", 5), ("6", 6), ("7", 6), ("8", 6), ("9", 6),
+                 ("10", 6), ("11", 6), ("12", 6), ("13", 6), ("14", 6), ("15", 6), ("16", 6), ("17", 6),
+                 ("18", 6), ("19", 6), ("20", 6), ("21", 6)]),
+    ("custom3", [("1", 1), ("2", 1), ("3", 1), ("4", 1), ("5", 2), ("6", 2)]),
+    ("AllToOne", [("1", 1), ("2", 1)]),
+    ("EightVsFive", [("1", 1), ("2", 1), ("3", 1), ("4", 1), ("5", 1), ("6", 1), ("7", 1), ("8", 1), ("9", 2),
+                     ("10", 2), ("11", 2), ("12", 2), ("13", 2), ("9999", 9999)]),
+    ("Classe_Social", [("1", 1), ("3", 2)]),
+    ("OneThreeTwo", [("1", 1), ("2", 2), ("3", 2), ("4", 2), ("5", 3), ("6", 3)]),
+    ("SixToThree", [("1", 1), ("2", 1), ("3", 2), ("4", 2), ("5", 3), ("6", 3), ("9999", 9999)]),
+    ("q37special", [("1", 1), ("2", 1), ("3", 2), ("4", 3), ("5", 1), ("6", 4), ("7", 5), ("8", 6), ("9", 7)]),
+    ("top2VersusBottom3", [("1", 1), ("2", 1), ("3", 2), ("4", 2), ("5", 2)]),
+    ("topVersusRestUpTo5", [("1", 1), ("2", 2), ("3", 2), ("4", 2), ("5", 2)]),
+    ("TopVersusRestUpTo10", [("1", 1), ("2", 2), ("3", 2), ("4", 2), ("5", 2), ("6", 2), ("7", 2), ("8", 2),
+                             ("9", 2), ("10", 2), ("9999", 9999), ("-99.99", 9999)]),
+    ("TopTwoVersusRestUpTo10", [("1", 1), ("2", 1), ("3", 2), ("4", 2), ("5", 2), ("6", 2), ("7", 2),
+                                ("8", 2), ("9", 2), ("10", 2), ("9999", 9999), ("-99.99", 9999)]),
+    ("bottomVersusRestUpTo4", [("1", 1), ("2", 1), ("3", 1), ("4", 2)]),
+    ("qKc", [("1", 1), ("2", 2), ("3", 2), ("4", 2), ("5", 2), ("6", 1), ("7", 2), ("8", 2), ("9", 3),
+             ("9999", 9999)]),
+    ("qKc2", [("1", 2), ("2", 2), ("3", 2), ("4", 2), ("5", 1), ("6", 2), ("7", 3), ("9999", 9999)]),
+    ("q37", [("1", 4), ("2", 1), ("3", 3), ("4", 2), ("5", 2), ("6", 2), ("7", 1), ("8", 3), ("9999", 9999)]),
+    ("q53special", [("1", 1), ("2", 1), ("3", 1), ("4", 2), ("5", 3), ("6", 4), ("7", 1), ("8", 5), ("9", 6),
+                    ("10", 6), ("11", 6), ("12", 6), ("13", 6), ("14", 6), ("15", 6), ("16", 6),
+                    ("9999", 9999)]),
+    ("Standard5To3", [("1", 1), ("2", 1), ("3", 2), ("4", 3), ("5", 3), ("9999", 9999)]),
+    ("standard4to2", [("1", 1), ("2", 1), ("3", 2), ("4", 2), ("9999", 9999)]),
+    ("OneOneTwoThree", [("1", 1), ("2", 1), ("3", 2), ("4", 3)]),
+    ("OneOneTwo", [("1", 1), ("2", 2), ("3", 3), ("4", 3), ("9999", 9999)]),
+    ("OneOneTwoTwoTwo", [("1", 1), ("2", 1), ("3", 2), ("4", 2), ("5", 2)]),
+    ("TwoOneOne", [("1", 1), ("2", 1), ("3", 2), ("4", 3)]),
+    ("OneOneTwoTwoThree", [("1", 1), ("2", 1), ("3", 2), ("4", 2), ("5", 3)]),
+    ("RE4", [("1", 1), ("2", 2), ("3", 3), ("4", 3), ("5", 3), ("6", 3), ("7", 3), ("8", 3), ("9", 3),
+             ("10", 3)]),
+    ("Q14abc", [("1", 1), ("2", 2), ("3", 3), ("4", 4), ("5", 5), ("6", 5), ("7", 5)]),
+]
+
+# The top level sections which follow customNetting
+CUSTOM_NETTING_TRAILER = """AUs:
     - AU02
     - AU12
     - AU04
@@ -802,11 +1183,165 @@ AUs:
     - Smile_v2
 csvLegend:
     - dummy
-"""
 
-def printYamlHeader():
+"""
 
-    print '''# the yaml file must define the following attributes:
+# Builds the lookup used by get_netting_name. Each built-in netting whose response
+# values run 1..n is indexed by its tuple of net numbers. The "UpTo" nettings are also
+# indexed by every prefix that still reaches their last net category, since they are
+# meant for any question with up to that many responses. Where nettings collide the
+# first one registered wins, so the priority names keep the matches they always had.
+# Input: the parsed built-in nettings, names to register first
+# Output: a dict mapping a tuple of net numbers to a netting name
+def build_netting_index(nettings, priority):
+
+    ordered = [netting for name in priority for netting in nettings if netting[0] == name] + \
+              [netting for netting in nettings if netting[0] not in priority]
+
+    index = {}
+    for name, pairs in ordered:
+        codes = dict([(key, float(value)) for key, value in pairs if key.isdigit() and key != "9999"])
+        if sorted([int(key) for key in codes]) != range(1, len(codes) + 1):
+            continue
+
+        netNumbers = tuple([codes[str(code)] for code in range(1, len(codes) + 1)])
+        index.setdefault(netNumbers, name)
+
+        if "UpTo" in name:
+            for length in range(2, len(netNumbers)):
+                if max(netNumbers[:length]) == max(netNumbers):
+                    index.setdefault(netNumbers[:length], name)
+
+    return index
+
+BUILTIN_NETTING_CODES = dict([(name, set([key for key, value in pairs])) for name, pairs in BUILTIN_NETTINGS])
+NETTING_INDEX = build_netting_index(BUILTIN_NETTINGS, ["TopVersusRestUpTo10", "TopTwoVersusRestUpTo10", "SixToThree"])
+
+# nettings that are already defined by the fixed block, and so are never written per question
+NETTING_TO_OMIT = ["0", ""] + [name for name, pairs in BUILTIN_NETTINGS]
+
+# Formats one question's entry in the customNetting section, or "" when the
+# question uses one of the standard nettings
+def format_custom_netting(question):
+
+    t_responseValues = question.responseValues
+    t_netNumbers = question.netNumbers
+    t_nettingName = question.nettingName
+    t_missingCodes = question.missingCodes
+
+    if t_nettingName in NETTING_TO_OMIT:
+        return ""
+
+    lines = ["    " + str(t_nettingName) + ":\n"]
+    for i, value in enumerate(t_responseValues):
+        lines.append("        \"" + str(int(value)) + "\": " + str(int(t_netNumbers[i])) + "\n")
+    for code in t_missingCodes:
+        lines.append("        \"" + code + "\": 9999\n")
+
+    return "".join(lines)
+
+# Formats the built-in nettings which follow the custom ones in the customNetting section
+# Input: the names of the nettings to write, or None to write all of them
+def format_builtin_nettings(names=None):
+
+    lines = ["\n"]
+    for name, pairs in BUILTIN_NETTINGS:
+        if names is None or name in names:
+            lines.append("    " + name + ":\n")
+            for code, netNumber in pairs:
+                lines.append("        \"" + code + "\": " + str(netNumber) + "\n")
+
+    return "".join(lines)
+
+# Formats the end of the customNetting section: the built-in nettings which the
+# questions use, or with legacyNettings every one of them as older versions of
+# this script wrote, then the sections which follow customNetting
+# Input: the set of netting names the questions use, and legacyNettings
+def format_custom_netting_footer(usedNettings, legacyNettings=False):
+
+    if legacyNettings:
+        return format_builtin_nettings() + CUSTOM_NETTING_TRAILER
+    return format_builtin_nettings(usedNettings) + CUSTOM_NETTING_TRAILER
+
+# Formats the line which opens the customNetting section. A section left without
+# entries is written as an empty mapping, so that it does not load as null.
+# Input: whether any custom netting is written, the set of netting names the
+#        questions use, and legacyNettings
+def format_custom_netting_heading(customNettings, usedNettings, legacyNettings=False):
+
+    if customNettings or legacyNettings or [name for name in usedNettings if name in BUILTIN_NETTING_CODES]:
+        return "customNetting:\n"
+    return "customNetting: {}\n"
+
+def printCustomNetting(questionData, out=None, legacyNettings=False):
+
+    if out is None:
+        out = sys.stdout
+
+    # questions sharing a custom netting reference one entry
+    emittedNettings = set()
+    entries = []
+    for question in questionData:
+        if question.nettingName not in emittedNettings:
+            emittedNettings.add(question.nettingName)
+            entries.append(format_custom_netting(question))
+    entries = "".join(entries)
+
+    out.write(format_custom_netting_heading(bool(entries), emittedNettings, legacyNettings))
+    out.write(entries)
+    out.write(format_custom_netting_footer(emittedNettings, legacyNettings))
+
+# Shared netting library for batch runs. Across a portfolio the same custom
+# netting turns up in many specs under different QuestionNNetting names. With a
+# registry, each custom netting is renamed after a digest of its map, so equal
+# nettings get one name in every spec and every run; the specs then reference a
+# library file holding those nettings and the built-in nettings they use, written once.
+class NettingRegistry(object):
+
+    PREFIX = "Netting"
+
+    # Input: the library filename as the yaml files written with this registry refer to it
+    def __init__(self, reference):
+        self.reference = reference
+        self.nettings = {}
+        self.names = {}
+        self.builtins = set()
+
+    # Output: the question, or a copy of it using the shared name of its custom netting
+    def share(self, question):
+        if question.nettingName in NETTING_TO_OMIT:
+            if question.nettingName in BUILTIN_NETTING_CODES:
+                self.builtins.add(question.nettingName)
+            return question
+
+        name = self.names.get(question.nettingName)
+        if name is None:
+            # the name line is left out, so only the map itself is hashed
+            body = format_custom_netting(question).split("\n", 1)[1]
+            name = self.PREFIX + hashlib.sha1(body).hexdigest()[:10]
+            self.nettings[name] = body
+            self.names[question.nettingName] = name
+
+        return Question(question.number, question.variableName, question.dashboardLabel, \
+                        question.responseValues, question.netNumbers, question.netLabels, \
+                        name, question.missingCodes)
+
+    # Input: another registry, whose nettings are added to this one's
+    def update(self, other):
+        self.nettings.update(other.nettings)
+        self.builtins.update(other.builtins)
+
+    # Output: the library file text: every shared netting, then the built-in nettings
+    #         used (all of them with legacyNettings)
+    def format_library(self, legacyNettings=False):
+        builtins = self.builtins
+        if legacyNettings:
+            builtins = None
+        return format_custom_netting_heading(bool(self.nettings), self.builtins, legacyNettings) + \
+               "".join(["    " + name + ":\n" + self.nettings[name] for name in sorted(self.nettings)]) + \
+               format_builtin_nettings(builtins)
+
+YAML_HEADER = '''# the yaml file must define the following attributes:
 #
 # studies: - a list of studies, each with a magicKey and magicValue String property
 #
@@ -861,99 +1396,2539 @@ videos:
         name: ""
         duration: 
         autoViewSequence:  
+
 '''
 
-def main():
+# The placeholder sections of YAML_HEADER which are filled from the spec
+STUDIES_PLACEHOLDER = "studies:\n    :\n        magicKey: \n        magicValue: live\n"
+VARS_CSV_PLACEHOLDER = "    csv:\n        movieId: MoviNam\n        pid: idx\n"
+VIDEOS_PLACEHOLDER = "videos:\n    :\n        name: \"\"\n        duration: \n        autoViewSequence:  \n"
+
+# Output: text as a double quoted yaml string
+def yaml_quoted(text):
+
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"').replace("\n", "\\n") \
+                     .replace("\r", "\\r").replace("\t", "\\t") + '"'
+
+# Words and numbers which a yaml 1.1 or 1.2 loader reads as something other than
+# the text they are written as, if they are left unquoted: booleans, nulls, dates,
+# and numbers with leading zeros, underscores, exponents or a base prefix. Only the
+# decimal numbers in YAML_PLAIN_NUMBER read back as the number they spell.
+YAML_PLAIN_TEXT = re.compile(r"^[A-Za-z0-9_]([A-Za-z0-9_ .\-]*[A-Za-z0-9_.\-])?$")
+YAML_RESERVED = re.compile(r"^(y|n|yes|no|true|false|on|off|null|~|[0-9]{4}-[0-9]{1,2}-[0-9]{1,2}.*)$", re.IGNORECASE)
+YAML_NUMERIC = re.compile(r"^[-+]?(?=.*[0-9])(0[bBoOxX][0-9a-fA-F_]+|[0-9_]*\.?[0-9_]*([eE][-+]?[0-9]+)?)$")
+YAML_PLAIN_NUMBER = re.compile(r"^(0|[1-9][0-9]*)(\.[0-9]+)?$")
+
+# Output: text usable as a yaml mapping key, quoted unless it is a plain word or
+#         phrase which a yaml loader reads back as the same string
+def yaml_key(text):
+
+    if YAML_PLAIN_TEXT.match(text) and not YAML_RESERVED.match(text) and not YAML_NUMERIC.match(text):
+        return text
+    return yaml_quoted(text)
+
+# Output: text usable as a yaml value, quoted unless it is a plain word, decimal
+#         number or phrase which a yaml loader reads back unchanged; "" stays empty
+def yaml_value(text):
+
+    if text == "":
+        return text
+    if YAML_PLAIN_TEXT.match(text) and not YAML_RESERVED.match(text) and \
+                    (not YAML_NUMERIC.match(text) or YAML_PLAIN_NUMBER.match(text)):
+        return text
+    return yaml_quoted(text)
+
+# Formats the yaml header, filling the studies, vars and videos sections with the
+# fields read from the DashboardSpec and DPSpec sheets (see read_workbook_header).
+# Fields which were not found keep their placeholder.
+# Input: a dict of header fields, or None
+def format_yaml_header(header=None):
+
+    if not header:
+        return YAML_HEADER
+
+    studies = "studies:\n    " + yaml_key(header.get("study", "")) + ":\n" + \
+              "        magicKey: " + yaml_value(header.get("magicKey", "")) + "\n" + \
+              "        magicValue: " + yaml_value(header.get("magicValue", "live")) + "\n"
+
+    csvVars = "    csv:\n" + \
+              "        movieId: " + yaml_value(header.get("movieIdVariable", "MoviNam")) + "\n" + \
+              "        pid: " + yaml_value(header.get("pidVariable", "idx")) + "\n"
+
+    videos = VIDEOS_PLACEHOLDER
+    if header.get("videos"):
+        videos = "videos:\n"
+        for video in header["videos"]:
+            videos += "    " + yaml_key(video.get("video") or video["name"]) + ":\n" + \
+                      "        name: " + yaml_quoted(video["name"]) + "\n" + \
+                      "        duration: " + yaml_value(video.get("duration", "")) + "\n" + \
+                      "        autoViewSequence: " + yaml_value(video.get("autoViewSequence", "")) + "\n"
+
+    return YAML_HEADER.replace(STUDIES_PLACEHOLDER, studies).replace(VARS_CSV_PLACEHOLDER, csvVars) \
+                      .replace(VIDEOS_PLACEHOLDER, videos)
+
+def printYamlHeader(out=None, header=None):
+
+    if out is None:
+        out = sys.stdout
+
+    out.write(format_yaml_header(header))
+
+# Writes a complete .dcc.yaml in a single pass over the questions, which may be
+# a generator such as iter_qboxes. The questions section is written straight to
+# out; the answers and customNetting sections are built alongside it in spooled
+# buffers and appended once the last question has been seen.
+# Input: an iterable of imported questions, a writable stream, the header fields
+#        read from the spec (see format_yaml_header), a NettingRegistry to
+#        move the nettings into, or None to write them in the spec, whether
+#        shared answer lists are written once (see AnswerAnchors), and whether
+#        every built-in netting is written rather than only those in use
+def write_spec(questions, out, header=None, nettings=None, answerAnchors=True, legacyNettings=False):
+
+    answers = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    customNetting = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    try:
+        printYamlHeader(out, header)
+        out.write("questions:\n")
+        anchors = None
+        if answerAnchors:
+            anchors = AnswerAnchors()
+
+        emittedNettings = set()
+        for question in questions:
+            if nettings is not None:
+                question = nettings.share(question)
+            out.write(format_question(question))
+            if anchors is not None:
+                anchors.write(question, answers)
+            else:
+                answers.write(format_answers(question))
+            if nettings is None and question.nettingName not in emittedNettings:
+                emittedNettings.add(question.nettingName)
+                customNetting.write(format_custom_netting(question))
+
+        out.write(QUESTIONS_FOOTER)
+        if nettings is None:
+            heading = format_custom_netting_heading(customNetting.tell() > 0, emittedNettings, legacyNettings)
+            customNetting.write(format_custom_netting_footer(emittedNettings, legacyNettings))
+        else:
+            customNetting.write("nettingLibrary: " + nettings.reference + "\n" + CUSTOM_NETTING_TRAILER)
 
-    #######################################################################
-    # 1: Input validation. Make sure the arguments and filenames given by  #
-    # the user make sense. Make sure the file is a current dashboard spec. #    
-    ########################################################################
-    
-    # Check to see that an argument was given:
-    if len(sys.argv) < 2:
-        print "usage: ./createSpecification.py <dashboard_spec.xls>"
-        sys.exit(0)                                 # TODO: replace with proper exception handling
-                                                    # TODO: replace with optparse
+        out.write("answers:\n")
+        answers.seek(0)
+        if anchors is not None:
+            anchors.copy(answers, out)
+        else:
+            shutil.copyfileobj(answers, out)
+        out.write(ANSWERS_FOOTER)
+        if nettings is None:
+            out.write(heading)
+        customNetting.seek(0)
+        shutil.copyfileobj(customNetting, out)
+    finally:
+        answers.close()
+        customNetting.close()
+
+# Writes the same outputs as write_spec_formats, one yaml section at a time and
+# then each other format, timing each as a profiler stage
+# Input: a list of imported questions, a dict of output format -> writable stream,
+#        a Profiler, the header fields, and legacyNettings as for write_spec
+def write_spec_in_stages(questionData, outputs, profiler, header=None, legacyNettings=False):
+
+    if "yaml" in outputs:
+        out = outputs["yaml"]
+        with profile_stage(profiler, "emit header"):
+            printYamlHeader(out, header)
+        with profile_stage(profiler, "emit questions"):
+            printQuestions(questionData, out)
+        with profile_stage(profiler, "emit answers"):
+            printAnswers(questionData, out, answerAnchors=True)
+        with profile_stage(profiler, "emit customNetting"):
+            printCustomNetting(questionData, out, legacyNettings)
+
+    for outputFormat in OUTPUT_FORMATS:
+        if outputFormat != "yaml" and outputFormat in outputs:
+            with profile_stage(profiler, "emit " + outputFormat):
+                write_spec_model(spec_model(questionData, header, legacyNettings=legacyNettings), \
+                                 outputs[outputFormat], outputFormat)
+
+# JSON and MessagePack output. The same spec is built as a model of dicts and
+# lists holding exactly what a yaml loader reads from the .dcc.yaml (keys in the
+# same order, scalars with the same types), and serialized compactly. The fixed
+# sections of the yaml are read into the model once, with a reader for the subset
+# of yaml this script writes.
+
+OUTPUT_FORMATS = ["yaml", "json", "msgpack"]
+OUTPUT_SUFFIXES = {"yaml": ".yaml", "json": ".json", "msgpack": ".msgpack"}
+
+# The plain scalars a yaml 1.1 loader such as PyYAML reads as nulls, booleans and
+# numbers. yaml_key and yaml_value quote all of these but the plain decimal numbers,
+# so the others only turn up in yaml written by hand.
+YAML_NULLS = ("", "~", "null", "Null", "NULL")
+YAML_BOOLEANS = {"true": True, "yes": True, "on": True, "false": False, "no": False, "off": False}
+YAML_INT = re.compile(r"^[-+]?(0b[01_]+|0x[0-9a-fA-F_]+|0[0-7_]+|0|[1-9][0-9_]*(:[0-5]?[0-9])*)$")
+YAML_FLOAT = re.compile(r"^([-+]?[0-9][0-9_]*\.[0-9_]*([eE][-+][0-9]+)?|\.[0-9][0-9_]*([eE][-+][0-9]+)?|" + \
+                        r"[-+]?[0-9][0-9_]*(:[0-5]?[0-9])+\.[0-9_]*|[-+]?\.(inf|Inf|INF)|\.(nan|NaN|NAN))$")
+
+# the escapes yaml_quoted writes besides \\ and \"
+YAML_ESCAPES = {"n": "\n", "r": "\r", "t": "\t"}
+
+# Output: the number a yaml 1.1 loader reads from text matching YAML_INT or YAML_FLOAT
+def yaml_number(text, number):
+
+    digits = text.replace("_", "")
+    sign = 1
+    if digits[:1] in ("-", "+"):
+        if digits[0] == "-":
+            sign = -1
+        digits = digits[1:]
+
+    if digits.lower() == ".inf":
+        return sign * float("inf")
+    if digits.lower() == ".nan":
+        return float("nan")
+    if ":" in digits:
+        # base 60, as in 1:30 for 90
+        value = 0
+        for part in digits.split(":"):
+            value = value * 60 + number(part)
+        return sign * value
+    if number is int and digits.startswith("0b"):
+        return sign * int(digits[2:], 2)
+    if number is int and digits.startswith("0x"):
+        return sign * int(digits[2:], 16)
+    if number is int and digits.startswith("0") and digits != "0":
+        return sign * int(digits, 8)
+    return sign * number(digits)
+
+# Output: the value a yaml loader gives a scalar written by this script
+def yaml_scalar(text):
+
+    text = text.strip()
+    if text.startswith('"') and text.endswith('"') and len(text) > 1:
+        return re.sub(r'\\(.)', lambda match: YAML_ESCAPES.get(match.group(1), match.group(1)), text[1:-1])
+    if text in YAML_NULLS:
+        return None
+    if text.lower() in YAML_BOOLEANS and text in (text.lower(), text.title(), text.upper()):
+        return YAML_BOOLEANS[text.lower()]
+    if YAML_INT.match(text):
+        return yaml_number(text, int)
+    if YAML_FLOAT.match(text):
+        return yaml_number(text, float)
+    return text
+
+# Output: a mapping key written by this script (see yaml_key), which is always a string
+def yaml_key_text(text):
+
+    text = text.strip()
+    if text.startswith('"') and text.endswith('"') and len(text) > 1:
+        return yaml_scalar(text)
+    return text
+
+# Splits a "key: value" line at the colon that ends its key
+# Output: a (key, value text) pair
+def split_yaml_entry(text):
+
+    if text.startswith('"'):
+        end = text.index('"', 1)
+        while text[end-1] == '\\':
+            end = text.index('"', end + 1)
+        return yaml_key_text(text[:end+1]), text[end+1:].lstrip()[1:]
+    if text.endswith(":"):
+        return yaml_key_text(text[:-1]), ""
+    key, value = text.split(": ", 1)
+    return yaml_key_text(key), value
+
+# Reads a block of yaml as written by this script: nested block mappings and
+# sequences of scalars or of mappings, with comments and blank lines ignored
+# Output: the block as an OrderedDict
+def read_yaml_block(text):
+
+    lines = []
+    for line in text.splitlines():
+        if line.strip() and not line.lstrip().startswith("#"):
+            lines.append((len(line) - len(line.lstrip()), line.strip()))
+
+    # Input: the index of the first line of a node, the node's indent
+    # Output: the node, and the index of the line after it
+    def read_node(i, indent):
+        if lines[i][1].startswith("- "):
+            node = []
+            while i < len(lines) and lines[i][0] == indent and lines[i][1].startswith("- "):
+                item = lines[i][1][2:]
+                if item.startswith('"') or ": " not in item and not item.endswith(":"):
+                    node.append(yaml_scalar(item))
+                    i += 1
+                else:
+                    # a mapping whose first entry shares the dash's line
+                    lines[i] = (indent + 2, item)
+                    value, i = read_node(i, indent + 2)
+                    node.append(value)
+            return node, i
+
+        node = collections.OrderedDict()
+        while i < len(lines) and lines[i][0] == indent:
+            key, value = split_yaml_entry(lines[i][1])
+            i += 1
+            if value.strip() == "" and i < len(lines) and lines[i][0] > indent:
+                node[key], i = read_node(i, lines[i][0])
+            else:
+                node[key] = yaml_scalar(value)
+        return node, i
 
-    # Verify that the argument is a valid filename:
-    dsFilename, dsFileExtension = os.path.splitext(sys.argv[1])
-    if not os.path.exists(dsFilename+dsFileExtension):
-        print "validation error: you have given the name of a file which does not exist."
-        sys.exit(0)                                  #TODO: replace with proper exception handling
+    if not lines:
+        return collections.OrderedDict()
+    return read_node(0, lines[0][0])[0]
 
-    # Verify that the filename points to an xls, xlsx, or xlsm file:
-    accepted_formats = ['.xls', '.xlsm', '.xlsx']
-    if dsFileExtension.lower() not in accepted_formats:
-        print "error: your dashboard spec file must be in one of the following formats: " + \
-        '[%s]' % ', '.join(map(str, accepted_formats))
-        sys.exit(0)                                  #TODO: replace with proper exception handling
+FIXED_QUESTIONS = read_yaml_block(QUESTIONS_FOOTER)
+FIXED_ANSWERS = read_yaml_block(ANSWERS_FOOTER)
+CUSTOM_NETTING_TRAILER_MODEL = read_yaml_block(CUSTOM_NETTING_TRAILER)
 
-    # Open the workbook:
-    workbook = xlrd.open_workbook(dsFilename+dsFileExtension)
+# Output: the questions section as the model of format_question and QUESTIONS_FOOTER
+def questions_model(questionData):
 
-    # Verify the workbook contains the expected worksheets:
-    expectedWorksheetTitles = ['DashboardSpec-->CS', 'DPSpec-->DP', 'NettingSpec-->idx', \
-                                                                   'Net-List', 'Costs', 'Lists']
-    unicodeExistingWorksheetTitles = workbook.sheet_names()
-    existingWorksheetTitles = map(str, unicodeExistingWorksheetTitles)
-    titleIntersection = [filter(lambda x: x in expectedWorksheetTitles, sublist) for sublist in \
-                                                                         existingWorksheetTitles]
-    titleIntersection = filter(None, titleIntersection)
-    if titleIntersection:
-        print "validation error: your dashboard specification file has tab names which differ" + \
-                                                                         " from what is expected."
-        sys.exit(0)                                  #TODO: replace with proper exception handling
-
-    # Verify the workbook is an acceptable version:
-    dashboardSpecificationSheet = workbook.sheet_by_name('DashboardSpec-->CS')
-    initial_row = dashboardSpecificationSheet.row_values(0)
-                                                     #TODO: repair date handling
-    date_ok = [a.start() for a in list(re.finditer("Updated 15 March", str(initial_row)))]
-    date_ok_2 = [a.start() for a in list(re.finditer("Updated 5 April", str(initial_row)))]
-    
-    if not (date_ok or date_ok_2):        
-        print "validation error: your dashboard spec file is out of date."
-        print "This script currently accepts spec files with the dates: 15 March 2013, 5 April 2013"
-        sys.exit(0)                                  #TODO: replace with proper exception handling
+    section = collections.OrderedDict()
+    for question in questionData:
+        section[str(question.variableName)] = collections.OrderedDict( \
+                    [("name", yaml_scalar('"' + question.dashboardLabel + '"')), ("netted", yaml_scalar(question.nettingName))])
+    section.update(FIXED_QUESTIONS)
+    return section
+
+# Output: the answers section as the model of format_answers and ANSWERS_FOOTER
+def answers_model(questionData):
+
+    section = collections.OrderedDict()
+    for question in questionData:
+        section[str(question.variableName)] = [collections.OrderedDict([("name", yaml_scalar('"' + label + '"')), \
+                                                       ("code", float(i+1))]) for i, label in enumerate(question.netLabels)]
+    section.update(FIXED_ANSWERS)
+    return section
+
+# Input: the names of the built-in nettings to include, or None for all of them
+# Output: the model of format_builtin_nettings
+def builtin_netting_model(names=None):
+
+    section = collections.OrderedDict()
+    for name, pairs in BUILTIN_NETTINGS:
+        if names is None or name in names:
+            section[name] = collections.OrderedDict(pairs)
+    return section
+
+# Output: the customNetting section as the model of format_custom_netting and
+#         format_builtin_nettings
+def custom_netting_model(questionData, legacyNettings=False):
+
+    section = collections.OrderedDict()
+    usedNettings = set()
+    for question in questionData:
+        usedNettings.add(question.nettingName)
+        if question.nettingName in NETTING_TO_OMIT or question.nettingName in section:
+            continue
+        netting = collections.OrderedDict()
+        for i, value in enumerate(question.responseValues):
+            netting[str(int(value))] = int(question.netNumbers[i])
+        for code in question.missingCodes:
+            netting[code] = 9999
+        section[question.nettingName] = netting
+    if legacyNettings:
+        usedNettings = None
+    section.update(builtin_netting_model(usedNettings))
+    return section
+
+# Builds the model of the .dcc.yaml write_spec would write for the same arguments
+# Output: an OrderedDict of the spec's top level sections
+def spec_model(questionData, header=None, nettings=None, legacyNettings=False):
+
+    if nettings is not None:
+        questionData = [nettings.share(question) for question in questionData]
+
+    model = read_yaml_block(format_yaml_header(header))
+    model["questions"] = questions_model(questionData)
+    model["answers"] = answers_model(questionData)
+    if nettings is None:
+        model["customNetting"] = custom_netting_model(questionData, legacyNettings)
+    else:
+        model["nettingLibrary"] = nettings.reference
+    model.update(CUSTOM_NETTING_TRAILER_MODEL)
+    return model
+
+# Input: a spec model, a writable stream, "json" or "msgpack"
+def write_spec_model(model, out, outputFormat):
+
+    if outputFormat == "json":
+        out.write(json.dumps(model, separators=(',', ':')))
+        out.write("\n")
+    elif outputFormat == "msgpack":
+        out.write(msgpack.packb(model, use_bin_type=False))
     else:
-        if PRINT_WARNINGS:
-            print "file is valid. opening NettingSpec worksheet.\r"
+        raise ValueError("unknown output format: " + outputFormat)
+
+# Writes a spec in each of several formats from one imported model
+# Input: an iterable of imported questions, a dict of output format -> writable
+#        stream, and the header fields, NettingRegistry and legacyNettings as
+#        for write_spec
+def write_spec_formats(questions, outputs, header=None, nettings=None, legacyNettings=False):
+
+    if outputs.keys() == ["yaml"]:
+        # a yaml only spec can still be streamed question by question
+        write_spec(questions, outputs["yaml"], header, nettings, legacyNettings=legacyNettings)
+        return
+
+    questionData = list(questions)
+    if "yaml" in outputs:
+        write_spec(questionData, outputs["yaml"], header, nettings, legacyNettings=legacyNettings)
+
+    model = spec_model(questionData, header, nettings, legacyNettings)
+    for outputFormat in OUTPUT_FORMATS:
+        if outputFormat != "yaml" and outputFormat in outputs:
+            write_spec_model(model, outputs[outputFormat], outputFormat)
+
+# Output: the filename of a format's output written beside the .dcc.yaml outputFilename
+def format_output_filename(outputFilename, outputFormat):
+
+    if outputFormat == "yaml":
+        return outputFilename
+    if outputFilename.endswith(OUTPUT_SUFFIXES["yaml"]):
+        outputFilename = outputFilename[:-len(OUTPUT_SUFFIXES["yaml"])]
+    return outputFilename + OUTPUT_SUFFIXES[outputFormat]
+
+# An on-disk cache of imported specs (header fields and question data), keyed by a
+# hash of the workbook bytes and PARSER_VERSION. Each model is pickled into its own file; reading an
+# entry refreshes its mtime, and the least recently used entries are evicted
+# whenever the cache grows past maxBytes.
+class SpecCache(object):
+
+    SUFFIX = ".model"
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, maxBytes=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.maxBytes = maxBytes
+
+    # Input: a workbook filename, or the workbook's contents
+    # Output: the hex digest identifying that workbook's contents
+    def key(self, filename, contents=None):
+        digest = hashlib.sha1(PARSER_VERSION + "\0")
+        if contents is not None:
+            digest.update(contents)
+            return digest.hexdigest()
+        workbookFile = open(filename, 'rb')
+        try:
+            for block in iter(lambda: workbookFile.read(1 << 16), ""):
+                digest.update(block)
+        finally:
+            workbookFile.close()
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    # Output: the cached (header, question data) pair, or None on a miss
+    def load(self, key):
+        path = self.path(key)
+        try:
+            modelFile = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                model = cPickle.load(modelFile)
+            except Exception:
+                # a truncated or stale entry is treated as a miss
+                return None
+        finally:
+            modelFile.close()
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return model
+
+    def store(self, key, model):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # another batch worker may have created it first
+                if not os.path.isdir(self.directory):
+                    raise
+
+        # write beside the entry and rename, so concurrent readers never see half a model
+        handle, tempPath = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        modelFile = os.fdopen(handle, 'wb')
+        try:
+            cPickle.dump(model, modelFile, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            modelFile.close()
+        os.rename(tempPath, self.path(key))
+
+        self.evict()
+
+    # Output: a list of (last used time, size in bytes, path) for each entry, oldest first
+    def entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        return sorted(entries)
+
+    # Removes the least recently used entries until the cache fits in maxBytes
+    def evict(self):
+        entries = self.entries()
+        totalBytes = sum([size for mtime, size, path in entries])
+
+        for mtime, size, path in entries:
+            if totalBytes <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            totalBytes -= size
+
+    def clear(self):
+        removed = 0
+        for mtime, size, path in self.entries():
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+def print_cache_info(cache):
+
+    entries = cache.entries()
+    totalBytes = sum([size for mtime, size, path in entries])
+
+    print "cache directory: " + cache.directory
+    print "entries:         " + str(len(entries))
+    print "size:            " + str(totalBytes) + " of " + str(cache.maxBytes) + " bytes"
+    print "parser version:  " + PARSER_VERSION
+
+# Streaming reader for OOXML (.xlsx/.xlsm) workbooks. A worksheet's XML is parsed
+# straight out of the zip archive with iterparse, each <row> being discarded once
+# its cells are stored, and cells are kept column by column (optionally only the
+# columns an ExtractionPlan reads). Shared string cells
+# hold their index into the shared string table, which is itself only parsed as
+# far as the highest index actually read. The workbook and worksheet objects
+# provide the parts of the xlrd Book and Sheet interfaces this script uses.
+OOXML_MAGIC = "PK\x03\x04"
+SPREADSHEET_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+RELATIONSHIP_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PACKAGE_RELATIONSHIP_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+CELL_ESCAPE = re.compile(r"_x([0-9A-Fa-f]{4})_")
+
+# Maps a spec workbook into memory read-only, so that it can be handed to the
+# readers as its contents without being copied
+# Output: an mmap of the file, or an empty string for an empty file
+def map_spec_file(dsFilename):
+
+    specFile = open(dsFilename, 'rb')
+    try:
+        if os.fstat(specFile.fileno()).st_size == 0:
+            return ""
+        return mmap.mmap(specFile.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        specFile.close()
+
+# Input: the filename of a spec workbook, or its contents as a string or mmap
+# Output: an XlsxWorkbook for OOXML files, otherwise an on demand xlrd Book. Both
+#         read the contents in place: a cStringIO reader shares the buffer it is
+#         given, and xlrd keeps slicing the buffer passed to it.
+def open_spec_workbook(dsFilename=None, contents=None):
+
+    mapped = contents is None
+    if mapped:
+        # xlrd closes its buffer itself once it no longer needs it
+        contents = map_spec_file(dsFilename)
+
+    # xlrd would take empty contents for none given, and open dsFilename instead
+    if len(contents) == 0:
+        raise SpecFileError("validation error: the dashboard spec you have given is empty.")
+
+    if contents[:len(OOXML_MAGIC)] == OOXML_MAGIC:
+        workbook = XlsxWorkbook(cStringIO.StringIO(contents))
+        if mapped:
+            workbook.mapping = contents
+        return workbook
+    if not mapped:
+        # xlrd closes the buffer it is given, and contents given here stay the caller's
+        contents = buffer(contents)
+    return xlrd.open_workbook(dsFilename, file_contents=contents, on_demand=True)
+
+# Output: the text of a <t> element, unescaped the way xlrd does it
+def ooxml_text(element):
+
+    text = element.text
+    if text is None:
+        return u''
+    if element.get(XML_SPACE) != "preserve":
+        text = text.strip()
+    return unicode(CELL_ESCAPE.sub(lambda match: unichr(int(match.group(1), 16)), text))
+
+# Output: the text of an <si> or <is> element, rich text runs included
+def ooxml_rich_text(element):
+
+    text = []
+    for child in element:
+        if child.tag == SPREADSHEET_NS + "t":
+            text.append(ooxml_text(child))
+        elif child.tag == SPREADSHEET_NS + "r":
+            for run in child:
+                if run.tag == SPREADSHEET_NS + "t":
+                    text.append(ooxml_text(run))
+
+    return u''.join(text)
+
+# Output: the 0-based row and column of a cell reference such as "AB12"
+def ooxml_cell_position(reference):
+
+    col = 0
+    for i, character in enumerate(reference):
+        if character.isdigit():
+            return int(reference[i:]) - 1, col - 1
+        if character != '$':
+            col = col * 26 + ord(character.upper()) - ord('A') + 1
+
+    raise ValueError("malformed cell reference " + reference)
+
+class XlsxSharedStrings(object):
+
+    def __init__(self, archive, path):
+        self.strings = []
+        self.elements = None
+        if path in archive.namelist():
+            self.elements = ElementTree.iterparse(archive.open(path))
+
+    def __getitem__(self, index):
+        while index >= len(self.strings) and self.elements is not None:
+            for event, element in self.elements:
+                if element.tag == SPREADSHEET_NS + "si":
+                    self.strings.append(ooxml_rich_text(element))
+                    element.clear()
+                    if index < len(self.strings):
+                        break
+            else:
+                self.elements = None
+
+        return self.strings[index]
+
+class XlsxWorkbook(object):
 
-    # Open the NettingSpec worksheet:
-    worksheet = workbook.sheet_by_name('NettingSpec-->')
+    # needed by xlrd.formatting.is_date_format_string
+    verbosity = 0
+    logfile = sys.stderr
+
+    def __init__(self, filename):
+        self.archive = zipfile.ZipFile(filename)
+        self.sheets = {}
+        # the mmap the archive is read from, when the workbook owns it
+        self.mapping = None
+
+        relationships = ElementTree.fromstring(self.archive.read("xl/_rels/workbook.xml.rels"))
+        targets = {}
+        for relationship in relationships.findall(PACKAGE_RELATIONSHIP_NS + "Relationship"):
+            target = relationship.get("Target")
+            if target.startswith("/"):
+                target = target[1:]
+            else:
+                target = "xl/" + target
+            targets[relationship.get("Id")] = target
+
+        workbookXml = ElementTree.fromstring(self.archive.read("xl/workbook.xml"))
+        self.sheetPaths = []
+        for sheet in workbookXml.iter(SPREADSHEET_NS + "sheet"):
+            self.sheetPaths.append((sheet.get("name"), targets[sheet.get(RELATIONSHIP_NS + "id")]))
+
+        self.sharedStrings = XlsxSharedStrings(self.archive, "xl/sharedStrings.xml")
+        self.dateStyles = self.read_date_styles()
+
+    # Output: the set of cell style indices whose number format is a date format
+    def read_date_styles(self):
+
+        dateStyles = set()
+        if "xl/styles.xml" not in self.archive.namelist():
+            return dateStyles
+
+        styles = ElementTree.fromstring(self.archive.read("xl/styles.xml"))
+        dateFormats = set(code for code, formatType in xlrd.formatting.std_format_code_types.items() \
+                                                                    if formatType == xlrd.formatting.FDT)
+        for numberFormat in styles.iter(SPREADSHEET_NS + "numFmt"):
+            if xlrd.formatting.is_date_format_string(self, numberFormat.get("formatCode")):
+                dateFormats.add(int(numberFormat.get("numFmtId")))
+
+        cellFormats = styles.find(SPREADSHEET_NS + "cellXfs")
+        if cellFormats is not None:
+            for index, cellFormat in enumerate(cellFormats.findall(SPREADSHEET_NS + "xf")):
+                if int(cellFormat.get("numFmtId", "0")) in dateFormats:
+                    dateStyles.add(index)
+
+        return dateStyles
+
+    def sheet_names(self):
+        return [name for name, path in self.sheetPaths]
+
+    # Input: a sheet name, and optionally the only columns to keep (all by default)
+    def sheet_by_name(self, name, columns=None):
+        if name not in self.sheets or self.sheets[name].columns != columns:
+            paths = dict(self.sheetPaths)
+            if name not in paths:
+                raise xlrd.XLRDError("No sheet named <%r>" % name)
+            self.sheets[name] = XlsxWorksheet(self, name, paths[name], columns)
+        return self.sheets[name]
+
+    def unload_sheet(self, name):
+        self.sheets.pop(name, None)
+
+    def release_resources(self):
+        self.sheets = {}
+        self.sharedStrings.elements = None
+        self.archive.close()
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+
+class XlsxWorksheet(object):
+
+    def __init__(self, workbook, name, path, columns=None):
+        self.name = name
+        self.columns = columns
+        self.sharedStrings = workbook.sharedStrings
+        self.types = {}
+        self.values = {}
+        self.nrows = 0
+        self.ncols = 0
+
+        rowx = -1
+        sheetData = None
+        for event, element in ElementTree.iterparse(workbook.archive.open(path), ("start", "end")):
+            if event == "start":
+                if element.tag == SPREADSHEET_NS + "sheetData":
+                    sheetData = element
+                continue
+            if element.tag != SPREADSHEET_NS + "row":
+                continue
+
+            if element.get("r") is None:
+                rowx += 1
+            else:
+                rowx = int(element.get("r")) - 1
+
+            colx = -1
+            for cell in element:
+                if cell.get("r") is None:
+                    colx += 1
+                else:
+                    colx = ooxml_cell_position(cell.get("r"))[1]
+                if columns is not None and colx not in columns:
+                    # the cell is not kept, but still counts towards the sheet's size
+                    if len(cell):
+                        self.nrows = max(self.nrows, rowx + 1)
+                        self.ncols = max(self.ncols, colx + 1)
+                    continue
+                cellType, value = self.read_cell(cell, workbook.dateStyles)
+                if cellType != xlrd.XL_CELL_EMPTY:
+                    self.put_cell(rowx, colx, cellType, value)
+
+            # rows that have been read are dropped from the tree being built
+            sheetData.clear()
+
+        for col in self.types:
+            self.pad_column(col, self.nrows)
+
+    # Output: the xlrd cell type and value of a <c> element; shared strings are
+    #         left as their index into the shared string table
+    def read_cell(self, cell, dateStyles):
+
+        cellType = cell.get("t", "n")
+        text = None
+        for child in cell:
+            if child.tag == SPREADSHEET_NS + "v":
+                text = ooxml_text(child) if cellType == "str" else child.text
+            elif child.tag == SPREADSHEET_NS + "is":
+                text = ooxml_rich_text(child)
+
+        if cellType == "n":
+            if not text:
+                return xlrd.XL_CELL_EMPTY, u''
+            if int(cell.get("s", "0")) in dateStyles:
+                return xlrd.XL_CELL_DATE, float(text)
+            return xlrd.XL_CELL_NUMBER, float(text)
+        elif cellType == "s":
+            if not text:
+                return xlrd.XL_CELL_EMPTY, u''
+            return xlrd.XL_CELL_TEXT, int(text)
+        elif cellType == "str":
+            return xlrd.XL_CELL_TEXT, text
+        elif cellType == "b":
+            return xlrd.XL_CELL_BOOLEAN, int(text in ("1", "true"))
+        elif cellType == "e":
+            return xlrd.XL_CELL_ERROR, xlrd.biffh.error_code_from_text[text or "#N/A"]
+        elif cellType == "inlineStr":
+            if not text:
+                return xlrd.XL_CELL_EMPTY, u''
+            return xlrd.XL_CELL_TEXT, text
+
+        raise ValueError("unknown cell type %r in worksheet %s" % (cellType, self.name))
+
+    def put_cell(self, rowx, colx, cellType, value):
+        if colx not in self.types:
+            self.types[colx] = array.array('B')
+            self.values[colx] = []
+        self.pad_column(colx, rowx)
+        self.types[colx].append(cellType)
+        self.values[colx].append(value)
+        self.nrows = max(self.nrows, rowx + 1)
+        self.ncols = max(self.ncols, colx + 1)
+
+    def pad_column(self, colx, rows):
+        missing = rows - len(self.types[colx])
+        if missing > 0:
+            self.types[colx].extend([xlrd.XL_CELL_EMPTY] * missing)
+            self.values[colx].extend([u''] * missing)
+
+    def resolve(self, cellType, value):
+        if cellType == xlrd.XL_CELL_TEXT and isinstance(value, int):
+            return self.sharedStrings[value]
+        return value
+
+    def cell_type(self, rowx, colx):
+        if not (0 <= rowx < self.nrows and 0 <= colx < self.ncols):
+            raise IndexError("cell (%d, %d) is outside worksheet %s" % (rowx, colx, self.name))
+        if colx not in self.types:
+            return xlrd.XL_CELL_EMPTY
+        return self.types[colx][rowx]
+
+    def cell_value(self, rowx, colx):
+        cellType = self.cell_type(rowx, colx)
+        if colx not in self.values:
+            return u''
+        return self.resolve(cellType, self.values[colx][rowx])
+
+    def col_types(self, colx, start_rowx=0, end_rowx=None):
+        if colx not in self.types:
+            return [xlrd.XL_CELL_EMPTY] * len(range(self.nrows)[start_rowx:end_rowx])
+        return self.types[colx][start_rowx:end_rowx].tolist()
+
+    def col_values(self, colx, start_rowx=0, end_rowx=None):
+        if colx not in self.values:
+            return [u''] * len(range(self.nrows)[start_rowx:end_rowx])
+        return [self.resolve(cellType, value) for cellType, value in \
+                zip(self.types[colx][start_rowx:end_rowx], self.values[colx][start_rowx:end_rowx])]
+
+    def row_values(self, rowx, start_colx=0, end_colx=None):
+        return [self.cell_value(rowx, colx) for colx in range(self.ncols)[start_colx:end_colx]]
+
+# Collects per-stage timings and worksheet cell access counts for --profile.
+# Each stage records its wall time and the process's peak resident memory when it
+# finished. Cell access is counted by patching the counted methods onto the
+# worksheet instance, so isinstance checks against it still hold.
+class Profiler(object):
+
+    COUNTED_METHODS = ("cell_type", "cell_value", "row_values", "col_types", "col_values")
+
+    def __init__(self):
+        self.origin = time.time()
+        self.stages = []
+        self.cellAccess = {}
+
+    def record(self, name, start, end):
+        self.stages.append((name, start, end, peak_memory()))
+
+    # Counts calls to the cell access methods of a worksheet (or ColumnSnapshot),
+    # keyed by the name of the function that made them
+    def instrument(self, worksheet):
+        for methodName in self.COUNTED_METHODS:
+            if hasattr(worksheet, methodName):
+                setattr(worksheet, methodName, self.counted(getattr(worksheet, methodName), methodName))
+
+    def counted(self, method, methodName):
+        cellAccess = self.cellAccess
+
+        def counted_method(*args):
+            frame = sys._getframe(1)
+            caller = frame.f_code.co_name
+            if caller == "__init__" and "self" in frame.f_locals:
+                caller = type(frame.f_locals["self"]).__name__
+            key = (caller, methodName)
+            cellAccess[key] = cellAccess.get(key, 0) + 1
+            return method(*args)
+
+        return counted_method
+
+    def report(self, stream):
+        stream.write("%-24s %10s %16s\n" % ("stage", "seconds", "peak memory (MB)"))
+        for name, start, end, peak in self.stages:
+            if peak is None:
+                stream.write("%-24s %10.4f %16s\n" % (name, end - start, "n/a"))
+            else:
+                stream.write("%-24s %10.4f %16.1f\n" % (name, end - start, peak / 1024.0))
+        stream.write("%-24s %10.4f\n" % ("total", time.time() - self.origin))
+
+        if self.cellAccess:
+            stream.write("\n%-28s %-12s %10s\n" % ("cell access by function", "method", "calls"))
+            for (caller, methodName), calls in sorted(self.cellAccess.items(), key=lambda item: -item[1]):
+                stream.write("%-28s %-12s %10d\n" % (caller, methodName, calls))
+
+        if ascii_text.hits + ascii_text.misses:
+            stream.write("\nascii text: %d lookups, %d strings normalized, %.1f%% served from the memo\n" % \
+                         (ascii_text.hits + ascii_text.misses, ascii_text.misses, 100 * ascii_text.hit_rate()))
+
+    # Writes the stages as a Chrome trace (chrome://tracing, Perfetto)
+    def write_trace(self, filename):
+        events = []
+        for name, start, end, peak in self.stages:
+            events.append({"name": name, "ph": "X", "pid": os.getpid(), "tid": 0,
+                           "ts": int((start - self.origin) * 1e6), "dur": int((end - start) * 1e6),
+                           "args": {"peakMemoryKB": peak}})
+            if peak is not None:
+                events.append({"name": "peak memory", "ph": "C", "pid": os.getpid(), "tid": 0,
+                               "ts": int((end - self.origin) * 1e6), "args": {"KB": peak}})
+
+        traceFile = open(filename, 'w')
+        try:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, traceFile)
+        finally:
+            traceFile.close()
+
+# Output: the peak resident memory of this process in KB, or None where unknown
+def peak_memory():
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X and in KB elsewhere
+    if sys.platform == "darwin":
+        peak /= 1024
+
+    return peak
+
+# Times the enclosed block as a profiler stage; does nothing without a profiler
+@contextlib.contextmanager
+def profile_stage(profiler, name):
+
+    start = time.time()
+    yield
+    if profiler is not None:
+        profiler.record(name, start, time.time())
+
+# Validates an open (on demand) workbook and locates the qboxes in its NettingSpec sheet
+# Input: a workbook opened with on_demand=True, and optionally a Profiler
+# Output: the worksheet (or its ColumnSnapshot) to import from, the qbox dimensions,
+#         and the ExtractionPlan of the workbook's layout
+def locate_workbook_qboxes(workbook, profiler=None):
+
+    with profile_stage(profiler, "validation"):
+        plan = check_workbook(workbook)
+
+    # Open the NettingSpec worksheet; the streaming xlsx reader only keeps the
+    # columns the plan reads
+    with profile_stage(profiler, "load NettingSpec"):
+        if isinstance(workbook, XlsxWorkbook):
+            worksheet = workbook.sheet_by_name(plan.sheets["netting"], plan.columns)
+        else:
+            worksheet = workbook.sheet_by_name(plan.sheets["netting"])
+    if profiler is not None:
+        profiler.instrument(worksheet)
 
     ###################################################################
     # 2: Import qbox data. Determine which qboxes need to be imported, #
     # their size and shape. Validate these qboxes; import their data.  #
     ####################################################################
     
+    # Capture the columns the extractors need in one pass when numpy is available
+    if numpy is not None:
+        with profile_stage(profiler, "snapshot"):
+            source = ColumnSnapshot(worksheet, plan.columns)
+        if profiler is not None:
+            profiler.instrument(source)
+        find_headers, find_footers = snapshot_qboxHeaderRows, snapshot_qbox_footers
+    else:
+        source = worksheet
+        find_headers, find_footers = locate_qboxHeaderRows, locate_qbox_footers
+
     # Count qboxes and identify their beginning rows
-    qboxHeaderRows = locate_qboxHeaderRows(worksheet)
+    with profile_stage(profiler, "header location"):
+        qboxHeaderRows = find_headers(source, plan)
     
-    if PRINT_WARNINGS:
-        print str(len(qboxHeaderRows)) + " questions have been found.\r"
+    logger.info("%s questions have been found.", len(qboxHeaderRows))
     
     # Determine the footer of each qbox, store with header as dimension pairs
-    qboxDimensions = locate_qbox_footers(worksheet, qboxHeaderRows)
+    with profile_stage(profiler, "footer location"):
+        qboxDimensions = find_footers(source, qboxHeaderRows, plan)
 
-    if PRINT_DEBUG:
-        print_qbox_questions(worksheet, qboxHeaderRows)
-        print_qboxes(worksheet, qboxDimensions)
+    # Check every qbox before any of them is imported
+    with profile_stage(profiler, "qbox validation"):
+        errors = validate_qboxes(source, qboxDimensions, plan)
+    if errors:
+        raise SpecValidationError(errors, plan)
 
-    # Import data from each qbox into a manageable structure
-    questionData = import_qboxes(worksheet, qboxDimensions)
+    if logger.isEnabledFor(logging.DEBUG):
+        print_qbox_questions(worksheet, qboxHeaderRows, plan)
+        print_qboxes(worksheet, qboxDimensions, plan)
 
+    return source, qboxDimensions, plan
 
-    ###################################################################
-    # 3: Create yaml file. Output questions, answers, customnetting,   #
-    # and header. Validate yaml output.                                #
-    ####################################################################
+# Determines the layout of a workbook from the version stamp of each known layout.
+# Only the row holding the stamp is read, once for all the layouts that share it.
+# Input: an open workbook
+# Output: the ExtractionPlan of the first matching layout, or None
+def detect_extraction_plan(workbook):
+
+    sheetNames = set(workbook.sheet_names())
+    versionRows = {}
 
-    printYamlHeader()
-    printQuestions(questionData)
-    printAnswers(questionData)
-    printCustomNetting(questionData)
+    for plan in EXTRACTION_PLANS:
+        if not (plan.sheets["netting"] in sheetNames and plan.versionSheet in sheetNames):
+            continue
+
+        location = (plan.versionSheet, plan.versionRow)
+        if location not in versionRows:
+            versionSheet = workbook.sheet_by_name(plan.versionSheet)
+            versionRows[location] = []
+            if plan.versionRow < versionSheet.nrows:
+                versionRows[location] = versionSheet.row_values(plan.versionRow)
+            workbook.unload_sheet(plan.versionSheet)
+
+        if plan.matches(versionRows[location]):
+            return plan
+
+    return None
+
+# Verifies that an open workbook has the expected worksheets and is a current spec version
+# Output: the ExtractionPlan of the workbook's layout
+def check_workbook(workbook):
+
+    plan = detect_extraction_plan(workbook)
+    if plan is not None:
+        logger.info("file is valid (%s layout). opening NettingSpec worksheet.", plan.name)
+        return plan
+
+    # Verify the workbook contains the expected worksheets:
+    sheetNames = set(workbook.sheet_names())
+    if not [plan for plan in EXTRACTION_PLANS if plan.sheets["netting"] in sheetNames and \
+                                                 plan.versionSheet in sheetNames]:
+        raise SpecLayoutError("validation error: your dashboard specification file has tab names which differ" + \
+                                                                         " from what is expected.")
+
+    # Otherwise the workbook is not an acceptable version:
+    raise SpecLayoutError("validation error: your dashboard spec file is out of date.\n" + \
+                          "This script currently accepts spec files with the dates: " + \
+                                    ", ".join([plan.name for plan in reversed(EXTRACTION_PLANS)]))
+
+# Verifies that a spec filename exists and has one of the accepted extensions
+def check_spec_filename(dsFilename):
+
+    # Verify that the argument is a valid filename:
+    dsFileExtension = os.path.splitext(dsFilename)[1]
+    if not os.path.exists(dsFilename):
+        raise SpecFileError("validation error: you have given the name of a file which does not exist.")
+
+    # Verify that the filename points to an xls, xlsx, or xlsm file:
+    if dsFileExtension.lower() not in ACCEPTED_FORMATS:
+        raise SpecFileError("error: your dashboard spec file must be in one of the following formats: " + \
+                            '[%s]' % ', '.join(map(str, ACCEPTED_FORMATS)))
+
+# Header sheets. The studies, vars and videos sections of the yaml header are
+# filled from the DashboardSpec and DPSpec sheets. Both are read one after the
+# other from the workbook already open for the NettingSpec, once its qboxes have
+# been located, and each is unloaded as soon as its fields have been read.
+
+HEADER_SHEETS = ["dashboard", "dp"]
+
+# Output: a header cell value as yaml text; whole numbers lose their ".0"
+def header_cell_text(value):
+
+    if isinstance(value, float):
+        if value == int(value):
+            return str(int(value))
+        return repr(value)
+    return ascii_text(unicode(value)).strip()
+
+# Output: the lower case form of a cell's text, as compared with the layout's labels
+def header_label(value):
+
+    if not isinstance(value, basestring):
+        return None
+    return ascii_text(value).strip().rstrip(":").strip().lower()
+
+# Reads the DashboardSpec fields of a plan. Each field is the first filled cell to
+# the right of its label; where a label appears twice the first one is used.
+# Output: a dict of field -> text
+def read_dashboard_fields(worksheet, plan=DEFAULT_PLAN):
+
+    fields = {}
+    for row in range(worksheet.nrows):
+        rowValues = worksheet.row_values(row)
+        for col, value in enumerate(rowValues):
+            field = plan.dashboardFields.get(header_label(value))
+            if field is None or field in fields:
+                continue
+            for neighbour in rowValues[col+1:]:
+                text = header_cell_text(neighbour)
+                if text:
+                    fields[field] = text
+                    break
+
+    return fields
+
+# Reads the video table of the DPSpec sheet: the rows below the heading row of the
+# video name column, up to the first row without a video name.
+# Output: a list of dicts of field -> text, one per video
+def read_dp_videos(worksheet, plan=DEFAULT_PLAN):
+
+    headingRow = None
+    for row in range(worksheet.nrows):
+        headings = [plan.videoColumns.get(header_label(value)) for value in worksheet.row_values(row)]
+        if "name" in headings:
+            headingRow = row
+            break
+    if headingRow is None:
+        return []
+
+    columns = dict((field, col) for col, field in reversed(list(enumerate(headings))) if field is not None)
+
+    videos = []
+    for row in range(headingRow + 1, worksheet.nrows):
+        rowValues = worksheet.row_values(row)
+        video = {}
+        for field, col in columns.items():
+            if col < len(rowValues):
+                text = header_cell_text(rowValues[col])
+                if text:
+                    video[field] = text
+        if "name" not in video:
+            break
+        videos.append(video)
+
+    return videos
+
+# Reads one header sheet of an open workbook, unloading it again afterwards
+# Input: the workbook, the ExtractionPlan of its layout, a sheet kind out of HEADER_SHEETS
+# Output: a dict of the header fields found on that sheet
+def read_header_sheet(workbook, plan, sheetKind):
+
+    sheetName = plan.sheets[sheetKind]
+    if sheetName not in workbook.sheet_names():
+        return {}
+
+    worksheet = workbook.sheet_by_name(sheetName)
+    try:
+        if sheetKind == "dashboard":
+            return read_dashboard_fields(worksheet, plan)
+        videos = read_dp_videos(worksheet, plan)
+        if videos:
+            return {"videos": videos}
+        return {}
+    finally:
+        if sheetName != plan.sheets["netting"]:
+            workbook.unload_sheet(sheetName)
+
+# Reads the header fields of a spec from its open workbook. The header sheets are
+# small, so they are read in the same pass as the NettingSpec rather than in
+# separate processes, which would each have to open the workbook again.
+# Input: the workbook, the ExtractionPlan of its layout
+# Output: the header fields, as format_yaml_header takes them
+def read_workbook_header(workbook, plan):
+
+    header = {}
+    for sheetKind in HEADER_SHEETS:
+        header.update(read_header_sheet(workbook, plan, sheetKind))
+    return header
+
+# Converts one dashboard spec workbook, writing its .dcc.yaml to out (stdout by default).
+# Every qbox is imported and checked before the first line is written, so a spec
+# error leaves nothing on out; with streaming, for an out which is only kept once
+# the conversion succeeds (see write_to_path), each question is instead written as
+# soon as its qbox has been imported. With a SpecCache, a workbook seen before is emitted from its cached model without
+# being opened by xlrd at all. With a desparsed csv, the nettings of questions whose
+# data uses missing-value codes are extended to map them (the cache is not used then).
+# With a NettingRegistry, custom nettings are moved into it (see write_spec). out may
+# also be a dict of output format -> stream, to write several formats at once. With
+# contents, the spec is read from them instead of from dsFilename. With legacyNettings,
+# every built-in netting is written, not only those the questions use.
+def convert_spec(dsFilename, out=None, cache=None, desparsedFilename=None, jobs=None, profiler=None, \
+                                nettings=None, contents=None, legacyNettings=False, streaming=False):
+
+    #######################################################################
+    # 1: Input validation. Make sure the arguments and filenames given by  #
+    # the user make sense. Make sure the file is a current dashboard spec. #    
+    ########################################################################
+
+    if contents is None:
+        check_spec_filename(dsFilename)
+
+    if out is None:
+        out = sys.stdout
+    outputs = out
+    if not isinstance(outputs, dict):
+        outputs = {"yaml": out}
+
+    if desparsedFilename is not None:
+        cache = None
+
+    if cache is not None:
+        with profile_stage(profiler, "cache lookup"):
+            cacheKey = cache.key(dsFilename, contents)
+            model = cache.load(cacheKey)
+        if model is not None:
+            header, questionData = model
+            check_spec_model(questionData)
+            if profiler is not None:
+                write_spec_in_stages(questionData, outputs, profiler, header, legacyNettings)
+            else:
+                write_spec_formats(questionData, outputs, header, nettings, legacyNettings)
+            return
+
+    # Open the workbook. Only the sheet index is parsed here; each worksheet is
+    # loaded when it is first asked for and unloaded once it has been read.
+    with profile_stage(profiler, "open"):
+        workbook = open_spec_workbook(dsFilename, contents)
+    try:
+        source, qboxDimensions, plan = locate_workbook_qboxes(workbook, profiler)
+
+        missingCodes = None
+        if desparsedFilename is not None:
+            variableNames = [get_variable_name(source, headerRow, plan) for headerRow, footerRow in qboxDimensions]
+            with profile_stage(profiler, "desparsed csv scan"):
+                missingCodes = scan_desparsed_csv(desparsedFilename, variableNames, jobs)
+            for variableName in variableNames:
+                if variableName in missingCodes:
+                    sys.stderr.write(variableName + ": " + ", ".join(sorted(missingCodes[variableName])) + "\n")
+
+        ###################################################################
+        # 3: Create yaml file. Output questions, answers, customnetting,   #
+        # and header. Validate yaml output.                                #
+        ####################################################################
+
+        if profiler is not None:
+            # import and emit each section separately so every stage can be timed
+            with profile_stage(profiler, "import"):
+                questionData = list(iter_qboxes(source, qboxDimensions, missingCodes=missingCodes, plan=plan))
+            with profile_stage(profiler, "check model"):
+                check_spec_model(questionData)
+            with profile_stage(profiler, "header sheets"):
+                header = read_workbook_header(workbook, plan)
+            if cache is not None:
+                cache.store(cacheKey, (header, questionData))
+            write_spec_in_stages(questionData, outputs, profiler, header, legacyNettings)
+        elif cache is not None:
+            # the whole model is needed for the cache entry, so import it first
+            questionData = import_qboxes(source, qboxDimensions, plan=plan)
+            check_spec_model(questionData)
+            header = read_workbook_header(workbook, plan)
+            cache.store(cacheKey, (header, questionData))
+            write_spec_formats(questionData, outputs, header, nettings, legacyNettings)
+        elif streaming:
+            # each qbox is imported just before its question is written
+            questionData = checked_questions(iter_qboxes(source, qboxDimensions, missingCodes=missingCodes, plan=plan))
+            write_spec_formats(questionData, outputs, read_workbook_header(workbook, plan), nettings, legacyNettings)
+        else:
+            questionData = list(iter_qboxes(source, qboxDimensions, missingCodes=missingCodes, plan=plan))
+            check_spec_model(questionData)
+            write_spec_formats(questionData, outputs, read_workbook_header(workbook, plan), nettings, legacyNettings)
+        workbook.unload_sheet(plan.sheets["netting"])
+    finally:
+        workbook.release_resources()
+
+# Validates a spec without converting it: only the columns the qbox extractors
+# read are loaded, and no yaml is produced. Exits non-zero if the spec has errors.
+# Output: the number of qboxes found
+def check_spec(dsFilename, profiler=None, contents=None):
+
+    if contents is None:
+        check_spec_filename(dsFilename)
+
+    with profile_stage(profiler, "open"):
+        workbook = open_spec_workbook(dsFilename, contents)
+    try:
+        source, qboxDimensions, plan = locate_workbook_qboxes(workbook, profiler)
+        workbook.unload_sheet(plan.sheets["netting"])
+    finally:
+        workbook.release_resources()
+
+    return len(qboxDimensions)
+
+# A spec imported by load_spec: its header fields, its imported questions and the
+# ExtractionPlan of the layout it was read with
+class SpecModel(object):
+
+    def __init__(self, header, questions, plan):
+        self.header = header
+        self.questions = questions
+        self.plan = plan
+
+    # Renders the spec to any writable stream
+    # Input: the stream, one of OUTPUT_FORMATS, and an optional NettingRegistry and
+    #        legacyNettings as for write_spec
+    def write(self, out, outputFormat="yaml", nettings=None, legacyNettings=False):
+
+        if outputFormat == "yaml":
+            write_spec(self.questions, out, self.header, nettings, legacyNettings=legacyNettings)
+        else:
+            write_spec_model(spec_model(self.questions, self.header, nettings, legacyNettings), out, outputFormat)
+
+    # Output: the OrderedDict the json and msgpack outputs are written from
+    def to_dict(self, nettings=None, legacyNettings=False):
+
+        return spec_model(self.questions, self.header, nettings, legacyNettings)
+
+# Imports a spec for use as a library: nothing is printed and the process is never
+# exited, every problem with the spec being raised as a SpecError subclass.
+# Input: the filename of a spec workbook or its contents as a string, and
+#        optionally a desparsed csv whose missing-value codes are to be mapped
+# Output: a SpecModel
+def load_spec(dsFilename=None, contents=None, desparsedFilename=None, jobs=None):
+
+    if contents is None:
+        check_spec_filename(dsFilename)
+
+    try:
+        workbook = open_spec_workbook(dsFilename, contents)
+    except (xlrd.XLRDError, zipfile.BadZipfile), e:
+        raise SpecFileError("Error: the spec could not be opened as a workbook: " + str(e))
+    try:
+        source, qboxDimensions, plan = locate_workbook_qboxes(workbook)
+
+        missingCodes = None
+        if desparsedFilename is not None:
+            variableNames = [get_variable_name(source, headerRow, plan) for headerRow, footerRow in qboxDimensions]
+            missingCodes = scan_desparsed_csv(desparsedFilename, variableNames, jobs)
+            for variableName in variableNames:
+                if variableName in missingCodes:
+                    logger.info("%s: %s", variableName, ", ".join(sorted(missingCodes[variableName])))
+
+        questionData = list(iter_qboxes(source, qboxDimensions, missingCodes=missingCodes, plan=plan))
+        workbook.unload_sheet(plan.sheets["netting"])
+        check_spec_model(questionData)
+
+        header = read_workbook_header(workbook, plan)
+    finally:
+        workbook.release_resources()
+
+    return SpecModel(header, questionData, plan)
+
+# Opens a new temporary file in the directory of outputFilename, named uniquely so
+# that conversions writing to the same directory never share one
+# Output: the open file and its filename
+def open_temp_file(outputFilename, mode):
+
+    fd, tempFilename = tempfile.mkstemp(prefix=os.path.basename(outputFilename) + ".", suffix=".tmp", \
+                                        dir=os.path.dirname(outputFilename) or os.curdir)
+    # mkstemp only lets the owner read the file; give it the permissions of any new file
+    os.chmod(tempFilename, OUTPUT_FILE_MODE)
+
+    return os.fdopen(fd, mode, OUTPUT_BUFFER_SIZE), tempFilename
+
+# Calls write with a buffered stream on a temporary file beside outputFilename,
+# which only replaces outputFilename once write has returned
+def write_to_path(outputFilename, write):
+
+    outputFile, tempFilename = open_temp_file(outputFilename, 'w')
+    try:
+        write(outputFile)
+        outputFile.close()
+    except:
+        outputFile.close()
+        os.remove(tempFilename)
+        raise
+
+    os.rename(tempFilename, outputFilename)
+
+# Like write_to_path, for several files at once: write is called with a dict of
+# output format -> stream, and no file is replaced unless write returns
+# Input: a dict of output format -> filename, the function writing them
+def write_to_paths(outputFilenames, write):
+
+    outputFiles = {}
+    tempFilenames = {}
+    try:
+        for outputFormat, outputFilename in outputFilenames.items():
+            mode = 'w'
+            if outputFormat == "msgpack":
+                mode = 'wb'
+            outputFiles[outputFormat], tempFilenames[outputFormat] = open_temp_file(outputFilename, mode)
+        write(outputFiles)
+        for outputFile in outputFiles.values():
+            outputFile.close()
+    except:
+        for outputFormat, outputFile in outputFiles.items():
+            outputFile.close()
+            os.remove(tempFilenames[outputFormat])
+        raise
+
+    for outputFormat, outputFilename in outputFilenames.items():
+        os.rename(tempFilenames[outputFormat], outputFilename)
+
+# Converts one spec into outputFilename, never leaving a partly written file behind.
+# Formats other than yaml are written beside it (see format_output_filename).
+def convert_spec_to_path(dsFilename, outputFilename, cache=None, desparsedFilename=None, jobs=None, profiler=None, \
+                                            nettings=None, formats=None, contents=None, legacyNettings=False):
+
+    # the temporary files written to are dropped if the conversion fails, so the
+    # questions can be written as they are imported
+    if not formats or formats == ["yaml"]:
+        write_to_path(outputFilename, lambda out: convert_spec(dsFilename, out, cache, desparsedFilename, jobs, \
+                                                         profiler, nettings, contents, legacyNettings, True))
+        return
+
+    outputFilenames = dict([(outputFormat, format_output_filename(outputFilename, outputFormat)) \
+                                                          for outputFormat in formats])
+    write_to_paths(outputFilenames, lambda outputs: convert_spec(dsFilename, outputs, cache, desparsedFilename, \
+                                               jobs, profiler, nettings, contents, legacyNettings, True))
+
+# Incremental regeneration. Each qbox is fingerprinted from the cells the
+# extractors read; the fingerprints of the last run are kept beside the output
+# in <output>.qboxes.json, and only questions whose fingerprint or netting name
+# changed are extracted again and patched into the existing .dcc.yaml. Everything
+# else in the file, including hand edits, is left as it was.
+
+FINGERPRINT_SUFFIX = ".qboxes.json"
+PATCHED_SECTIONS = ["questions:", "answers:", "customNetting:"]
+
+# Input: an open worksheet (or ColumnSnapshot), a qbox header and footer
+# Output: a hex digest of every cell the extractors read for that qbox
+def qbox_fingerprint(worksheet, headerRow, footerRow, plan=DEFAULT_PLAN):
+
+    digest = hashlib.sha1(str(footerRow - headerRow))
+
+    if isinstance(worksheet, ColumnSnapshot):
+        for col in plan.columns:
+            for cell in zip(worksheet.types[col][headerRow:footerRow], worksheet.values[col][headerRow:footerRow]):
+                digest.update(repr(cell))
+    else:
+        for col in plan.columns:
+            for row in range(headerRow, footerRow):
+                digest.update(repr((worksheet.cell_type(row, col), worksheet.cell_value(row, col))))
+
+    return digest.hexdigest()
+
+# Output: a dict of variable name -> (question number, fingerprint, netting name)
+#         recorded by the previous run and the yaml header it wrote, or None if
+#         there is nothing usable
+def read_spec_fingerprints(outputFilename):
+
+    try:
+        recordFile = open(outputFilename + FINGERPRINT_SUFFIX)
+    except IOError:
+        return None
+    try:
+        try:
+            record = json.load(recordFile)
+        except ValueError:
+            return None
+    finally:
+        recordFile.close()
+
+    if record.get("parserVersion") != PARSER_VERSION:
+        return None
+
+    fingerprints = {}
+    for variableName, questionNumber, fingerprint, nettingName in record["qboxes"]:
+        fingerprints[str(variableName)] = (questionNumber, str(fingerprint), str(nettingName))
+
+    return fingerprints, str(record["header"])
+
+# Input: the output filename, a list of (variable name, question number, fingerprint, netting name),
+#        the yaml header written
+def write_spec_fingerprints(outputFilename, records, headerText):
+
+    recordFile = open(outputFilename + FINGERPRINT_SUFFIX + ".tmp", 'w')
+    try:
+        json.dump({"parserVersion": PARSER_VERSION, "qboxes": records, "header": headerText}, recordFile)
+    finally:
+        recordFile.close()
+    os.rename(outputFilename + FINGERPRINT_SUFFIX + ".tmp", outputFilename + FINGERPRINT_SUFFIX)
+
+# Splits the lines of one yaml section into its top level entries
+# Input: the lines between a section header and the next section
+# Output: a list of [key, lines] items; runs of lines that are not part of an
+#         entry (blank lines, comments) are kept as items with a key of None
+def split_section_entries(lines):
+
+    items = []
+    for line in lines:
+        isKey = line.startswith("    ") and not line.startswith("     ") and line.rstrip().endswith(":")
+        if isKey:
+            items.append([line.strip()[:-1], [line]])
+        elif line.startswith("     ") and items and items[-1][0] is not None:
+            items[-1][1].append(line)
+        elif items and items[-1][0] is None:
+            items[-1][1].append(line)
+        else:
+            items.append([None, [line]])
+
+    return items
+
+# Applies a set of changes to the entries of one yaml section
+# Input: the section's items from split_section_entries, a set of keys to remove,
+#        and a list of (key, text, preceding keys) for each entry to write. An entry
+#        whose key already exists is replaced in place; otherwise it is inserted
+#        after the last of its preceding keys present in the section.
+def patch_section_entries(items, removals, entries):
+
+    items = [item for item in items if item[0] not in removals]
+
+    for key, text, precedingKeys in entries:
+        newItem = [key, text.splitlines(True)]
+        positions = dict([(item[0], i) for i, item in enumerate(items) if item[0] is not None])
+
+        if key in positions:
+            items[positions[key]] = newItem
+            continue
+
+        insertAt = 0
+        for precedingKey in reversed(precedingKeys):
+            if precedingKey in positions:
+                insertAt = positions[precedingKey] + 1
+                break
+        items.insert(insertAt, newItem)
+
+    return items
+
+# Patches the questions, answers and customNetting sections of an existing .dcc.yaml
+# Input: the yaml's lines, the current question order as a list of
+#        (variable name, netting name), the re-extracted questions, the variable
+#        names and netting names that are no longer in use
+# Output: the patched lines
+def patch_spec_lines(lines, order, questions, removedNames, removedNettings):
+
+    sectionStarts = [i for i, line in enumerate(lines) if line.rstrip() in PATCHED_SECTIONS]
+    if len(sectionStarts) != len(PATCHED_SECTIONS):
+        return None
+
+    # entries are matched on their keys as written, quoted where need be
+    removedKeys = set([yaml_key(str(variableName)) for variableName in removedNames])
+    changes = {
+        "questions:": (removedKeys, [(yaml_key(str(q.variableName)), format_question(q)) for q in questions]),
+        "answers:": (removedKeys, [(yaml_key(str(q.variableName)), format_answers(q)) for q in questions]),
+        "customNetting:": (set(removedNettings), [(q.nettingName, format_custom_netting(q)) for q in questions \
+                                                                    if format_custom_netting(q)]),
+    }
+    keyOrder = {
+        "questions:": [yaml_key(str(variableName)) for variableName, nettingName in order],
+        "answers:": [yaml_key(str(variableName)) for variableName, nettingName in order],
+        # the standard nettings live in the fixed block after the per-question ones
+        "customNetting:": [nettingName for variableName, nettingName in order \
+                                          if nettingName not in NETTING_TO_OMIT],
+    }
+
+    patched = []
+    position = 0
+    for start in sectionStarts:
+        # a section runs until the next top level key
+        end = start + 1
+        while end < len(lines) and (lines[end][:1] in (" ", "\n", "\r", "#") or lines[end] == ""):
+            end += 1
+
+        section = lines[start].rstrip()
+        removals, texts = changes[section]
+        entries = []
+        for key, text in texts:
+            precedingKeys = keyOrder[section][:keyOrder[section].index(key)]
+            entries.append((key, text, precedingKeys))
+
+        items = patch_section_entries(split_section_entries(lines[start+1:end]), removals, entries)
+
+        patched.extend(lines[position:start+1])
+        for key, itemLines in items:
+            patched.extend(itemLines)
+        position = end
+
+    patched.extend(lines[position:])
+
+    return patched
+
+# Replaces everything before the questions section with a new yaml header
+# Output: the patched lines, or None if there is no questions section
+def patch_spec_header(lines, headerText):
+
+    for i, line in enumerate(lines):
+        if line.rstrip() == "questions:":
+            return headerText.splitlines(True) + lines[i:]
+    return None
+
+# Regenerates outputFilename from a spec, re-extracting only the qboxes whose
+# cells changed since the fingerprints recorded by the previous run. Falls back to
+# a full conversion when there is no usable previous output. The yaml header is
+# only rewritten when the header sheets changed, so hand edits to it are kept.
+# Output: a (added, modified, removed) tuple of variable name lists, or None after
+#         a full conversion
+def regenerate_spec(dsFilename, outputFilename, contents=None):
+
+    if contents is None:
+        check_spec_filename(dsFilename)
+
+    previous = None
+    if os.path.exists(outputFilename):
+        previous = read_spec_fingerprints(outputFilename)
+    if previous is not None:
+        previous, previousHeader = previous
+
+    workbook = open_spec_workbook(dsFilename, contents)
+    try:
+        source, qboxDimensions, plan = locate_workbook_qboxes(workbook)
+
+        header = read_workbook_header(workbook, plan)
+        headerText = format_yaml_header(header)
+
+        variableNames = [get_variable_name(source, headerRow, plan) for headerRow, footerRow in qboxDimensions]
+        fingerprints = [qbox_fingerprint(source, headerRow, footerRow, plan) for headerRow, footerRow in qboxDimensions]
+
+        # Custom netting names depend on the questions before them, so they are worked
+        # out for the whole spec; only the net numbers are read for this.
+        if isinstance(source, ColumnSnapshot):
+            read_response_values, read_net_numbers = snapshot_response_values, snapshot_net_numbers
+        else:
+            read_response_values, read_net_numbers = get_response_values, get_net_numbers
+        customNettings = {}
+        nettingNames = []
+        for i, (headerRow, footerRow) in enumerate(qboxDimensions):
+            nettingNames.append(assign_netting_name(read_response_values(source, headerRow, footerRow, plan), \
+                                                    read_net_numbers(source, headerRow, footerRow, plan), \
+                                                    i+1, customNettings))
+
+        # entries are patched by variable name, which only works if they are unique
+        if previous is not None and len(set(variableNames)) != len(variableNames):
+            previous = None
+
+        if previous is None:
+            questionData = import_qboxes(source, qboxDimensions, plan=plan)
+            workbook.unload_sheet(plan.sheets["netting"])
+            check_spec_model(questionData)
+            # entries are patched one at a time later, so none may alias another's answers,
+            # and the built-in nettings are all written as a question may start using any
+            write_to_path(outputFilename, lambda out: write_spec(questionData, out, header, answerAnchors=False, \
+                                                                 legacyNettings=True))
+            write_spec_fingerprints(outputFilename, [[q.variableName, q.number, fingerprints[i], q.nettingName] \
+                                                           for i, q in enumerate(questionData)], headerText)
+            return None
+
+        changed = [i for i, variableName in enumerate(variableNames) \
+                        if previous.get(variableName, (None, None, None))[1:] != (fingerprints[i], nettingNames[i])]
+        questionData = import_qboxes(source, [qboxDimensions[i] for i in changed], [i+1 for i in changed], \
+                                                      [nettingNames[i] for i in changed], plan)
+        workbook.unload_sheet(plan.sheets["netting"])
+    finally:
+        workbook.release_resources()
+
+    removedNames = [variableName for variableName in previous if variableName not in variableNames]
+    added = [variableNames[i] for i in changed if variableNames[i] not in previous]
+    modified = [variableNames[i] for i in changed if variableNames[i] in previous]
+
+    order = zip(variableNames, nettingNames)
+
+    # drop the nettings only the removed or modified questions were using
+    stillUsed = set(nettingNames)
+    removedNettings = [previous[variableName][2] for variableName in removedNames + modified \
+                            if previous[variableName][2] not in stillUsed and \
+                               previous[variableName][2] not in NETTING_TO_OMIT]
+
+    if changed or removedNames or headerText != previousHeader:
+        outputFile = open(outputFilename)
+        try:
+            lines = outputFile.readlines()
+        finally:
+            outputFile.close()
+
+        patched = patch_spec_lines(lines, order, questionData, removedNames, removedNettings)
+        if patched is not None and headerText != previousHeader:
+            patched = patch_spec_header(patched, headerText)
+        if patched is None:
+            # the previous output no longer has the expected sections; start over
+            os.remove(outputFilename + FINGERPRINT_SUFFIX)
+            return regenerate_spec(dsFilename, outputFilename, contents)
+
+        write_to_path(outputFilename, lambda out: out.writelines(patched))
+
+    write_spec_fingerprints(outputFilename, [[variableName, i+1, fingerprints[i], nettingNames[i]] \
+                                                   for i, variableName in enumerate(variableNames)], headerText)
+
+    return (added, modified, removedNames)
+
+# Desparsed csv scanning. The csv is memory-mapped and split into byte ranges that
+# end on line boundaries; worker processes search their range for the missing-value
+# codes with mmap.find and only parse the lines that contain one, so memory use does
+# not grow with the size of the file.
+
+# missing-value codes, as written in the customNetting section, by numeric value
+MISSING_CODES = {9999.0: "9999", -99.99: "-99.99"}
+CSV_CHUNK_SIZE = 64 << 20
+
+# Splits a desparsed csv into ranges for scan_csv_range
+# Input: the csv filename, the approximate size of each range in bytes
+# Output: a list of (start, end) byte offsets covering every line after the header
+def split_csv_ranges(csvFilename, chunkSize=CSV_CHUNK_SIZE):
+
+    size = os.path.getsize(csvFilename)
+    if size == 0:
+        return []
+
+    csvFile = open(csvFilename, 'rb')
+    try:
+        data = mmap.mmap(csvFile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = data.find("\n") + 1
+            if start == 0:
+                return []
+
+            ranges = []
+            while start < size:
+                end = start + chunkSize
+                if end >= size:
+                    end = size
+                else:
+                    newline = data.find("\n", end)
+                    end = size if newline == -1 else newline + 1
+                ranges.append((start, end))
+                start = end
+        finally:
+            data.close()
+    finally:
+        csvFile.close()
+
+    return ranges
+
+# Scans one byte range of a desparsed csv inside a worker process
+# Input: a (csv filename, start, end, column indices) tuple
+# Output: a dict of column index -> set of missing-value codes found in that column
+def scan_csv_range(job):
+
+    csvFilename, start, end, columns = job
+    found = {}
+
+    csvFile = open(csvFilename, 'rb')
+    try:
+        data = mmap.mmap(csvFile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for token in ("9999", "-99.99"):
+                pos = data.find(token, start, end)
+                while pos != -1:
+                    lineStart = max(data.rfind("\n", start, pos) + 1, start)
+                    lineEnd = data.find("\n", pos, end)
+                    if lineEnd == -1:
+                        lineEnd = end
+
+                    fields = csv.reader([data[lineStart:lineEnd].rstrip("\r\n")]).next()
+                    for col in columns:
+                        if col >= len(fields):
+                            continue
+                        try:
+                            code = MISSING_CODES.get(float(fields[col]))
+                        except ValueError:
+                            continue
+                        if code is not None:
+                            found.setdefault(col, set()).add(code)
+
+                    pos = data.find(token, lineEnd, end)
+        finally:
+            data.close()
+    finally:
+        csvFile.close()
+
+    return found
+
+# Finds the columns of a desparsed csv which hold the data of the given questions
+# Input: the csv filename, the variable names of the questions
+# Output: a dict of column index -> variable name
+def find_csv_columns(csvFilename, variableNames):
+
+    csvFile = open(csvFilename, 'rb')
+    try:
+        header = csv.reader([csvFile.readline()]).next()
+    except StopIteration:
+        header = []
+    finally:
+        csvFile.close()
+
+    header = [name.strip() for name in header]
+    columns = {}
+    for variableName in variableNames:
+        if variableName in header:
+            columns[header.index(variableName)] = variableName
+        else:
+            logger.info("no column for question %s in the desparsed csv file.", variableName)
+
+    return columns
+
+# Runs a range function over every range of a desparsed csv, in a process pool
+# when there is more than one range
+# Input: the range function, the csv filename, the column indices to read, the
+#        number of worker processes (None for one per core)
+# Output: the list of results, one per range
+def map_csv_ranges(function, csvFilename, columns, jobs=None):
+
+    work = [(csvFilename, start, end, sorted(columns)) for start, end in split_csv_ranges(csvFilename)]
+    if not columns or not work:
+        return []
+
+    if len(work) == 1:
+        return [function(work[0])]
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(function, work, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+# Finds the questions whose columns in a desparsed csv hold missing-value codes
+# Input: the csv filename, the variable names of the questions, the number of
+#        worker processes (None for one per core)
+# Output: a dict of variable name -> set of missing-value codes used in its column
+def scan_desparsed_csv(csvFilename, variableNames, jobs=None):
+
+    columns = find_csv_columns(csvFilename, variableNames)
+    results = map_csv_ranges(scan_csv_range, csvFilename, columns, jobs)
+
+    missingCodes = {}
+    for found in results:
+        for col, codes in found.items():
+            missingCodes.setdefault(columns[col], set()).update(codes)
+
+    return missingCodes
+
+# Response code histograms. Every line of the desparsed csv is parsed, a block of
+# lines at a time, and the values of each question's column in a block are
+# counted together (with numpy.unique where numpy is available). Workers count
+# their own ranges and the parent adds up their histograms, so memory use only
+# depends on the block size and the number of distinct codes.
+
+CSV_BLOCK_SIZE = 1 << 20
+
+# Adds the values of some columns of a block of csv rows to their histograms
+# Input: a list of parsed rows, the sorted column indices, a dict of column
+#        index -> dict of cell text -> rows, which is updated
+def count_csv_rows(rows, columns, histograms):
+
+    if not rows:
+        return
+
+    pick = operator.itemgetter(*columns)
+    try:
+        picked = map(pick, rows)
+    except IndexError:
+        # short rows are missing their trailing blank cells
+        width = columns[-1] + 1
+        picked = map(pick, [row + [""] * (width - len(row)) for row in rows])
+
+    if numpy is not None:
+        # one row of strings per csv row, one column per question
+        table = numpy.array(picked).reshape(len(rows), len(columns))
+        columnValues = [table[:, i] for i in range(len(columns))]
+    elif len(columns) == 1:
+        columnValues = [picked]
+    else:
+        columnValues = zip(*picked)
+
+    for col, values in zip(columns, columnValues):
+        if numpy is not None:
+            codes, frequencies = numpy.unique(values, return_counts=True)
+            counted = zip(codes.tolist(), frequencies.tolist())
+        else:
+            counted = collections.Counter(values).iteritems()
+        histogram = histograms[col]
+        for code, frequency in counted:
+            histogram[code] = histogram.get(code, 0) + frequency
+
+# Counts the values in some columns of one byte range of a desparsed csv, inside
+# a worker process
+# Input: a (csv filename, start, end, column indices) tuple
+# Output: a dict of column index -> dict of cell text -> number of rows
+def count_csv_range(job):
+
+    csvFilename, start, end, columns = job
+    histograms = dict((col, {}) for col in columns)
+
+    csvFile = open(csvFilename, 'rb')
+    try:
+        data = mmap.mmap(csvFile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            position = start
+            while position < end:
+                blockEnd = min(position + CSV_BLOCK_SIZE, end)
+                if blockEnd < end:
+                    newline = data.find("\n", blockEnd, end)
+                    blockEnd = end if newline == -1 else newline + 1
+                count_csv_rows(list(csv.reader(data[position:blockEnd].splitlines())), columns, histograms)
+                position = blockEnd
+        finally:
+            data.close()
+    finally:
+        csvFile.close()
+
+    return histograms
+
+# Output: the response code a csv cell holds: a number where the text is one,
+#         otherwise the stripped text, or None for a blank cell
+def response_code(text):
+
+    text = text.strip()
+    if not text:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+# Output: a response code as it is written in the report
+def format_response_code(code):
+
+    if isinstance(code, float):
+        if code == int(code):
+            return str(int(code))
+        return repr(code)
+    return '"' + code + '"'
+
+# Builds the histogram of response codes in each question's column of a desparsed csv
+# Input: the csv filename, the variable names of the questions, the number of
+#        worker processes (None for one per core)
+# Output: a dict of variable name -> dict of response code -> number of rows, for
+#         the questions which have a column; blank cells are not counted
+def count_desparsed_responses(csvFilename, variableNames, jobs=None):
+
+    columns = find_csv_columns(csvFilename, variableNames)
+
+    histograms = dict((variableName, {}) for variableName in columns.values())
+    for counted in map_csv_ranges(count_csv_range, csvFilename, columns, jobs):
+        for col, texts in counted.items():
+            histogram = histograms[columns[col]]
+            for text, frequency in texts.items():
+                code = response_code(text)
+                if code is not None:
+                    histogram[code] = histogram.get(code, 0) + frequency
+
+    return histograms
+
+# Checks the answers of a spec against the data of a desparsed csv: each question's
+# response values are compared with the codes found in its column, and its
+# histogram is printed along with the codes it declares that the data never uses
+# and the codes the data uses that it does not declare.
+# Input: the spec filename, the csv filename, the number of worker processes, and
+#        optionally the contents of the spec to read instead of the file
+# Output: the number of questions whose data uses codes they do not declare, other
+#         than the missing-value codes
+def analyze_desparsed_responses(dsFilename, csvFilename, jobs=None, contents=None):
+
+    if contents is None:
+        check_spec_filename(dsFilename)
+
+    workbook = open_spec_workbook(dsFilename, contents)
+    try:
+        source, qboxDimensions, plan = locate_workbook_qboxes(workbook)
+        questionData = import_qboxes(source, qboxDimensions, plan=plan)
+        workbook.unload_sheet(plan.sheets["netting"])
+    finally:
+        workbook.release_resources()
+
+    histograms = count_desparsed_responses(csvFilename, [q.variableName for q in questionData], jobs)
+
+    flagged = 0
+    for question in questionData:
+        if question.variableName not in histograms:
+            continue
+        histogram = histograms[question.variableName]
+        declared = set(question.responseValues)
+
+        print question.variableName + ": " + str(sum(histogram.values())) + " responses; " + \
+              " ".join([format_response_code(code) + "=" + str(histogram[code]) for code in sorted(histogram)])
+
+        unobserved = sorted(declared - set(histogram))
+        if unobserved:
+            print "    declared but never observed: " + ", ".join(map(format_response_code, unobserved))
+
+        undeclared = sorted(set(histogram) - declared)
+        if undeclared:
+            notes = []
+            for code in undeclared:
+                note = format_response_code(code) + " (" + str(histogram[code]) + " row"
+                if histogram[code] != 1:
+                    note += "s"
+                if code in MISSING_CODES:
+                    note += ", missing-value code mapped by -x"
+                notes.append(note + ")")
+            print "    observed but never declared: " + ", ".join(notes)
+            if [code for code in undeclared if code not in MISSING_CODES]:
+                flagged += 1
+
+    return flagged
+
+# Converts a single spec inside a batch worker process
+# Input: a (workbook filename, output filename, SpecCache or None, netting library
+#        filename or None, list of output formats or None, legacyNettings) tuple
+# Output: a tuple of (workbook filename, output filename, success flag, message,
+#         NettingRegistry of the shared nettings the spec uses, or None)
+def convert_spec_to_file(job):
+
+    dsFilename, outputFilename, cache, libraryFilename, formats, legacyNettings = job
+
+    nettings = None
+    if libraryFilename is not None:
+        nettings = NettingRegistry(os.path.relpath(libraryFilename, os.path.dirname(os.path.abspath(outputFilename))))
+
+    try:
+        if outputFilename is None:
+            check_spec(dsFilename)
+        else:
+            convert_spec_to_path(dsFilename, outputFilename, cache, nettings=nettings, formats=formats, \
+                                 legacyNettings=legacyNettings)
+    except SpecError, e:
+        return (dsFilename, outputFilename, False, str(e), None)
+    except Exception, e:
+        return (dsFilename, outputFilename, False, "%s: %s" % (e.__class__.__name__, e), None)
+
+    return (dsFilename, outputFilename, True, "", nettings)
+
+# Determines which workbooks a batch run should convert
+# Input: a directory or a glob pattern
+# Output: a sorted list of spec workbook filenames
+def find_spec_workbooks(pattern):
+
+    if os.path.isdir(pattern):
+        candidates = glob.glob(os.path.join(pattern, '*'))
+    else:
+        candidates = glob.glob(pattern)
+
+    workbooks = []
+    for candidate in candidates:
+        # skip excel lock files such as ~$spec.xlsx
+        if os.path.basename(candidate).startswith('~$'):
+            continue
+        if os.path.splitext(candidate)[1].lower() in ACCEPTED_FORMATS and os.path.isfile(candidate):
+            workbooks.append(candidate)
+
+    return sorted(workbooks)
+
+# Output: the .dcc.yaml filename for a workbook, in outputDir or else beside the workbook
+def spec_output_filename(dsFilename, outputDir=None):
+
+    basename = os.path.splitext(os.path.basename(dsFilename))[0] + '.dcc.yaml'
+    if outputDir:
+        return os.path.join(outputDir, basename)
+
+    return os.path.join(os.path.dirname(dsFilename), basename)
+
+# Converts every spec workbook matched by pattern, one .dcc.yaml file per workbook
+# Input: a directory or glob, an output directory (None to write beside each workbook),
+#        the number of worker processes (None for one per core), an optional SpecCache,
+#        whether to only validate each workbook (see check_spec), the filename of
+#        a shared netting library to write (see NettingRegistry) or None, and the
+#        output formats to write (None for yaml only)
+# Output: a list of (workbook filename, output filename, success flag, message) tuples;
+#         the output filename is None when only validating
+def batch_convert(pattern, outputDir=None, jobs=None, cache=None, checkOnly=False, libraryFilename=None, \
+                                                                   formats=None, legacyNettings=False):
+
+    workbooks = find_spec_workbooks(pattern)
+
+    if outputDir and not os.path.isdir(outputDir) and not checkOnly:
+        os.makedirs(outputDir)
+
+    work = []
+    for dsFilename in workbooks:
+        if checkOnly:
+            work.append((dsFilename, None, None, None, None, False))
+        else:
+            work.append((dsFilename, spec_output_filename(dsFilename, outputDir), cache, libraryFilename, formats, \
+                                                                                             legacyNettings))
+
+    if not work:
+        return []
+
+    # workbooks such as spec.xls and spec.xlsx would be written to the same file,
+    # so none of them is converted
+    sharedOutputs = {}
+    for job in work:
+        if job[1] is not None:
+            sharedOutputs.setdefault(os.path.normcase(os.path.abspath(job[1])), []).append(job[0])
+    clashes = {}
+    for dsFilenames in sharedOutputs.values():
+        if len(dsFilenames) > 1:
+            for dsFilename in dsFilenames:
+                clashes[dsFilename] = "the output file would also be written for " + \
+                            ", ".join([other for other in dsFilenames if other != dsFilename]) + ".\n" + \
+                            "please rename one of these spec files and then try this program again."
+
+    converted = {}
+    pending = [job for job in work if job[0] not in clashes]
+    if pending:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            for result in pool.map(convert_spec_to_file, pending, chunksize=1):
+                converted[result[0]] = result
+        finally:
+            pool.close()
+            pool.join()
+
+    results = []
+    for job in work:
+        if job[0] in clashes:
+            results.append((job[0], job[1], False, clashes[job[0]], None))
+        else:
+            results.append(converted[job[0]])
+
+    if libraryFilename is not None and not checkOnly:
+        library = NettingRegistry(None)
+        for result in results:
+            if result[4] is not None:
+                library.update(result[4])
+        write_to_path(libraryFilename, lambda out: out.write(library.format_library(legacyNettings)))
+
+    return [result[:4] for result in results]
+
+def print_batch_summary(results):
+
+    failures = [result for result in results if not result[2]]
+
+    for dsFilename, outputFilename, ok, message in results:
+        if ok and outputFilename is None:
+            print "ok      " + dsFilename
+        elif ok:
+            print "ok      " + dsFilename + " -> " + outputFilename
+        else:
+            print "FAILED  " + dsFilename
+            for line in message.splitlines():
+                print "        " + line
+
+    action = " converted, "
+    if results and results[0][1] is None:
+        action = " valid, "
+    print str(len(results) - len(failures)) + " of " + str(len(results)) + " spec files" + action + \
+                                                            str(len(failures)) + " failed."
+
+    return len(failures)
+
+# Resident conversion daemon. The script stays loaded and answers requests on a
+# Unix domain socket, one json object per line in each direction:
+#     {"spec": "/path/spec.xls"}                         -> {"ok": true, "yaml": "..."}
+#     {"spec": "/path/spec.xls", "output": "/path/out"}  -> {"ok": true, "output": "/path/out"}
+#     {"spec": "/path/spec.xls", "check": true}          -> {"ok": true, "questions": 12}
+#     {"spec": ..., "desparsed": "/path/data.csv"} maps missing-value codes as -x does.
+#     {"spec": ..., "legacyNettings": true} writes every built-in netting as --legacy-nettings does.
+# A failed request answers {"ok": false, "status": <exit status>, "errors": [...]}
+# with the lines of the SpecError message that stopped the conversion. Paths are
+# resolved against the daemon's working directory. Parsed models are kept in memory between requests,
+# and the daemon can also watch a directory and regenerate the .dcc.yaml of any
+# workbook in it that changes.
+
+# number of parsed models the daemon keeps in memory
+RESIDENT_MODELS = 64
+# seconds between two scans of a watched directory
+DEFAULT_WATCH_INTERVAL = 2.0
+
+# A SpecCache which keeps the most recently used models in memory as well. With
+# no directory, models are only kept in memory.
+class ResidentSpecCache(SpecCache):
+
+    def __init__(self, directory=None, maxBytes=DEFAULT_CACHE_SIZE, maxModels=RESIDENT_MODELS):
+        SpecCache.__init__(self, directory, maxBytes)
+        self.maxModels = maxModels
+        self.models = collections.OrderedDict()
+
+    def load(self, key):
+        if key in self.models:
+            model = self.models.pop(key)
+            self.models[key] = model
+            return model
+        if self.directory is None:
+            return None
+
+        model = SpecCache.load(self, key)
+        if model is not None:
+            self.remember(key, model)
+        return model
+
+    def store(self, key, model):
+        self.remember(key, model)
+        if self.directory is not None:
+            SpecCache.store(self, key, model)
+
+    def remember(self, key, model):
+        self.models.pop(key, None)
+        self.models[key] = model
+        while len(self.models) > self.maxModels:
+            self.models.popitem(last=False)
+
+    def entries(self):
+        if self.directory is None:
+            return []
+        return SpecCache.entries(self)
+
+# Carries out one daemon request
+# Input: the decoded request, a SpecCache
+# Output: the response, ready to be encoded as json
+def handle_spec_request(request, cache):
+
+    if not isinstance(request, dict) or not request.get("spec"):
+        return {"ok": False, "status": 2, "errors": ["a request needs the filename of a spec"]}
+
+    dsFilename = request["spec"]
+    outputFilename = request.get("output")
+
+    out = cStringIO.StringIO()
+    try:
+        if request.get("check"):
+            return {"ok": True, "questions": check_spec(dsFilename)}
+        elif outputFilename:
+            convert_spec_to_path(dsFilename, outputFilename, cache, request.get("desparsed"), \
+                                 legacyNettings=bool(request.get("legacyNettings")))
+            return {"ok": True, "output": outputFilename}
+        else:
+            convert_spec(dsFilename, out, cache, request.get("desparsed"), \
+                         legacyNettings=bool(request.get("legacyNettings")))
+            return {"ok": True, "yaml": out.getvalue()}
+    except SpecError, e:
+        return {"ok": False, "status": e.status, "errors": str(e).splitlines()}
+    except Exception, e:
+        return {"ok": False, "status": 1, "errors": ["%s: %s" % (e.__class__.__name__, e)]}
+
+class SpecRequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                response = {"ok": False, "status": 2, "errors": ["the request is not valid json"]}
+            else:
+                # the resident cache is shared with the other requests and the
+                # watcher, so conversions run one at a time
+                with self.server.lock:
+                    response = handle_spec_request(request, self.server.cache)
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+class SpecServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, socketPath, cache, lock):
+        self.cache = cache
+        self.lock = lock
+        remove_stale_socket(socketPath)
+        SocketServer.UnixStreamServer.__init__(self, socketPath, SpecRequestHandler)
+        os.chmod(socketPath, 0600)
+
+# Removes a socket file left behind by a daemon which is no longer running, and
+# raises a DaemonRunningError if a daemon is still listening on it
+def remove_stale_socket(socketPath):
+
+    if not os.path.exists(socketPath):
+        return
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            probe.connect(socketPath)
+        except socket.error:
+            os.remove(socketPath)
+        else:
+            raise DaemonRunningError("a daemon is already listening on " + socketPath)
+    finally:
+        probe.close()
+
+# Sends one request to a running daemon
+# Input: the daemon's socket filename, the request as a dict
+# Output: the decoded response
+def send_spec_request(socketPath, request):
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socketPath)
+        client.sendall(json.dumps(request) + "\n")
+        response = client.makefile('rb').readline()
+    finally:
+        client.close()
+
+    return json.loads(response)
+
+# Polls a directory and regenerates the .dcc.yaml of each workbook that changes.
+# A workbook is converted once its size and modification time are the same on two
+# scans in a row, so one that is still being saved is left until it settles.
+# Outputs that are already newer than their workbook are left alone at start-up.
+class SpecWatcher(object):
+
+    def __init__(self, directory, outputDir, cache, lock, interval=DEFAULT_WATCH_INTERVAL, legacyNettings=False):
+        self.directory = directory
+        self.outputDir = outputDir
+        self.cache = cache
+        self.lock = lock
+        self.legacyNettings = legacyNettings
+        self.interval = interval
+        self.seen = {}
+        self.converted = {}
+
+        if outputDir and not os.path.isdir(outputDir):
+            os.makedirs(outputDir)
+
+    def poll(self):
+        seen = {}
+        for dsFilename in find_spec_workbooks(self.directory):
+            try:
+                stat = os.stat(dsFilename)
+            except OSError:
+                continue
+            signature = (stat.st_mtime, stat.st_size)
+            seen[dsFilename] = signature
+
+            outputFilename = spec_output_filename(dsFilename, self.outputDir)
+            if dsFilename not in self.seen and dsFilename not in self.converted:
+                try:
+                    if os.stat(outputFilename).st_mtime >= stat.st_mtime:
+                        self.converted[dsFilename] = signature
+                except OSError:
+                    pass
+
+            if signature == self.seen.get(dsFilename) and signature != self.converted.get(dsFilename):
+                with self.lock:
+                    result = convert_spec_to_file((dsFilename, outputFilename, self.cache, None, None, \
+                                                   self.legacyNettings))
+                self.converted[dsFilename] = signature
+                print_watch_result(result)
+
+        self.seen = seen
+
+    def run(self):
+        while True:
+            self.poll()
+            time.sleep(self.interval)
+
+def print_watch_result(result):
+
+    dsFilename, outputFilename, ok, message = result[:4]
+    if ok:
+        sys.stderr.write("regenerated " + outputFilename + "\n")
+    else:
+        sys.stderr.write("FAILED  " + dsFilename + "\n")
+        for line in message.splitlines():
+            sys.stderr.write("        " + line + "\n")
+
+# Runs the daemon until it is interrupted
+# Input: the socket filename (None to only watch), a ResidentSpecCache, and the
+#        directory to watch (None for none), its output directory and poll interval
+def serve(socketPath, cache, watchDir=None, outputDir=None, interval=DEFAULT_WATCH_INTERVAL, legacyNettings=False):
+
+    lock = threading.Lock()
+    watcher = None
+    if watchDir:
+        watcher = SpecWatcher(watchDir, outputDir, cache, lock, interval, legacyNettings)
+
+    if socketPath is None:
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    server = SpecServer(socketPath, cache, lock)
+    try:
+        if watcher is not None:
+            watchThread = threading.Thread(target=watcher.run)
+            watchThread.daemon = True
+            watchThread.start()
+        sys.stderr.write("listening on " + socketPath + "\n")
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+
+def main():
+
+    parser = optparse.OptionParser(usage="usage: %prog <dashboard_spec.xls | -> [-f <output_file>] [-x <desparsed.csv>]\n" + \
+                                         "       %prog -b <directory or glob> [-o <output_dir>] [-j <jobs>]\n" + \
+                                         "       %prog <dashboard_spec.xls> | -b <directory or glob> --check\n" + \
+                                         "       %prog --serve <socket> [--watch <directory> [-o <output_dir>]]")
+    parser.add_option("-f", "--output-file", dest="outputFile", metavar="FILE",
+                      help="write the .dcc.yaml to FILE instead of stdout (\"-\" for stdout)")
+    parser.add_option("-i", "--incremental", dest="incremental", action="store_true", default=False,
+                      help="with -f: re-extract only the qboxes changed since the last run and " + \
+                           "patch them into the existing output")
+    parser.add_option("-x", "--desparsed", dest="desparsed", metavar="CSV",
+                      help="map the missing-value codes (9999, -99.99) used in this desparsed csv " + \
+                           "in the nettings of the questions that use them")
+    parser.add_option("--histograms", dest="histograms", action="store_true", default=False,
+                      help="with -x: instead of converting, count the response codes in each question's " + \
+                           "column of the csv, and report codes declared but never observed and " + \
+                           "observed but never declared")
+    parser.add_option("-b", "--batch", dest="batch", metavar="PATTERN",
+                      help="convert every spec workbook in a directory or matching a glob")
+    parser.add_option("-o", "--output-dir", dest="outputDir", metavar="DIR",
+                      help="batch and watch modes: write .dcc.yaml files here instead of beside each workbook")
+    parser.add_option("--format", dest="formats", metavar="LIST", default="yaml",
+                      help="comma separated output formats out of " + ", ".join(OUTPUT_FORMATS) + \
+                           "; json and msgpack files are written beside the .dcc.yaml as .dcc.json " + \
+                           "and .dcc.msgpack (default: %default)")
+    parser.add_option("--netting-library", dest="nettingLibrary", metavar="FILE",
+                      help="with -b: give equal custom nettings one content-derived name across all specs " + \
+                           "and write them, with the built-in nettings, to FILE for the specs to reference")
+    parser.add_option("--legacy-nettings", dest="legacyNettings", action="store_true", default=False,
+                      help="write every built-in netting into customNetting (or the netting library), " + \
+                           "as older versions did, instead of only those the questions use")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", metavar="N",
+                      help="number of worker processes for -b and -x (default: one per core)")
+    parser.add_option("--cache", dest="cache", action="store_true", default=False,
+                      help="reuse models parsed from identical workbooks (cached in " + DEFAULT_CACHE_DIR + ")")
+    parser.add_option("--cache-dir", dest="cacheDir", metavar="DIR",
+                      help="keep the model cache in DIR (implies --cache)")
+    parser.add_option("--cache-size", dest="cacheSize", type="int", metavar="MB",
+                      default=DEFAULT_CACHE_SIZE >> 20,
+                      help="evict least recently used models beyond this size (default: %default MB)")
+    parser.add_option("--cache-info", dest="cacheInfo", action="store_true", default=False,
+                      help="print the location, entry count and size of the model cache")
+    parser.add_option("--cache-clear", dest="cacheClear", action="store_true", default=False,
+                      help="remove every model from the cache")
+    parser.add_option("--serve", dest="serve", metavar="SOCKET",
+                      help="run as a daemon answering json conversion requests on the unix socket SOCKET")
+    parser.add_option("--watch", dest="watch", metavar="DIR",
+                      help="daemon: regenerate the .dcc.yaml of each workbook in DIR when it changes " + \
+                           "(written to -o if given)")
+    parser.add_option("--watch-interval", dest="watchInterval", type="float", metavar="SECONDS",
+                      default=DEFAULT_WATCH_INTERVAL,
+                      help="daemon: seconds between scans of the watched directory (default: %default)")
+    parser.add_option("--check", dest="check", action="store_true", default=False,
+                      help="only validate the spec (or with -b, every spec) and report all of its " + \
+                           "errors; no yaml is written")
+    parser.add_option("--profile", dest="profile", action="store_true", default=False,
+                      help="report the time and peak memory of each stage, and the worksheet " + \
+                           "cell reads made by each function, on stderr")
+    parser.add_option("--profile-trace", dest="profileTrace", metavar="FILE",
+                      help="also write the stages to FILE as a Chrome trace (implies --profile)")
+    parser.add_option("-v", "--verbose", dest="verbose", action="count", default=0,
+                      help="report the questions found and the response values corrected; " + \
+                           "given twice, also dump every qbox and the values imported from it")
+    (options, args) = parser.parse_args()
+
+    # the log goes to stderr, so that it never mixes with a yaml written to stdout
+    logging.basicConfig(stream=sys.stderr, format="%(message)s", level=logging.WARNING - 10 * options.verbose)
+
+    profiler = None
+    if options.profile or options.profileTrace:
+        if options.batch or options.incremental:
+            parser.error("--profile cannot be combined with -b or -i")
+        profiler = Profiler()
+
+    if options.histograms and (not options.desparsed or options.batch or options.incremental or \
+                                                    options.outputFile or options.check):
+        parser.error("--histograms needs -x and cannot be combined with -b, -f, -i or --check")
+
+    if options.check and (options.incremental or options.outputFile or options.desparsed):
+        parser.error("--check cannot be combined with -f, -i or -x")
+
+    formats = []
+    for outputFormat in options.formats.split(","):
+        if outputFormat.strip() not in OUTPUT_FORMATS:
+            parser.error("unknown output format: " + outputFormat)
+        if outputFormat.strip() not in formats:
+            formats.append(outputFormat.strip())
+    if "msgpack" in formats and msgpack is None:
+        parser.error("msgpack output needs the msgpack package")
+    if formats != ["yaml"]:
+        if options.incremental or options.check or options.serve or options.watch:
+            parser.error("--format cannot be combined with -i, --check, --serve or --watch")
+        if len(formats) > 1 and not options.batch and (not options.outputFile or options.outputFile == "-"):
+            parser.error("writing several formats needs an output file given with -f")
+
+    if options.nettingLibrary and (not options.batch or options.check):
+        parser.error("--netting-library needs -b and cannot be combined with --check")
+
+    if options.serve or options.watch:
+        if options.batch or options.incremental or options.outputFile or options.check or profiler:
+            parser.error("--serve and --watch cannot be combined with -b, -f, -i, --check or --profile")
+        cacheDir = None
+        if options.cache or options.cacheDir:
+            cacheDir = options.cacheDir or DEFAULT_CACHE_DIR
+        try:
+            serve(options.serve, ResidentSpecCache(cacheDir, options.cacheSize << 20), options.watch, \
+                                           options.outputDir, options.watchInterval, options.legacyNettings)
+        except SpecError, e:
+            print str(e)
+            sys.exit(e.status)
+        return
+
+    cache = None
+    if options.cache or options.cacheDir or options.cacheInfo or options.cacheClear:
+        cache = SpecCache(options.cacheDir or DEFAULT_CACHE_DIR, options.cacheSize << 20)
+
+    if options.cacheClear:
+        print str(cache.clear()) + " cached models removed from " + cache.directory
+    if options.cacheInfo:
+        print_cache_info(cache)
+    if (options.cacheClear or options.cacheInfo) and not (options.batch or args):
+        return
+
+    if options.batch:
+        results = batch_convert(options.batch, options.outputDir, options.jobs, cache, options.check, \
+                                options.nettingLibrary, formats, options.legacyNettings)
+        if not results:
+            print "no dashboard spec files matched " + options.batch
+            sys.exit(1)
+        if options.nettingLibrary:
+            print "shared nettings written to " + options.nettingLibrary
+        if print_batch_summary(results):
+            sys.exit(1)
+        return
+
+    # Check to see that an argument was given:
+    if len(args) < 1:
+        print "usage: ./createSpecification.py <dashboard_spec.xls>"
+        sys.exit(0)                                 # TODO: replace with proper exception handling
+
+    # "-" reads the workbook from stdin; it is then parsed straight from memory
+    contents = None
+    if args[0] == "-":
+        contents = sys.stdin.read()
+
+    try:
+        if options.check:
+            print args[0] + ": " + str(check_spec(args[0], profiler, contents)) + " questions, no errors found."
+        elif options.histograms:
+            if analyze_desparsed_responses(args[0], options.desparsed, options.jobs, contents):
+                sys.exit(1)
+        elif options.incremental:
+            if not options.outputFile or options.outputFile == "-":
+                parser.error("--incremental needs an output file given with -f")
+            if options.desparsed:
+                parser.error("--incremental cannot be combined with -x")
+            changes = regenerate_spec(args[0], options.outputFile, contents)
+            if changes is None:
+                print "regenerated " + options.outputFile
+            else:
+                added, modified, removed = changes
+                print "patched " + options.outputFile + ": " + str(len(added)) + " added, " + \
+                      str(len(modified)) + " modified, " + str(len(removed)) + " removed."
+        elif options.outputFile and options.outputFile != "-":
+            convert_spec_to_path(args[0], options.outputFile, cache, options.desparsed, options.jobs, profiler, \
+                                 formats=formats, contents=contents, legacyNettings=options.legacyNettings)
+        else:
+            convert_spec(args[0], {formats[0]: sys.stdout}, cache=cache, desparsedFilename=options.desparsed, \
+                         jobs=options.jobs, profiler=profiler, contents=contents, legacyNettings=options.legacyNettings)
+    except SpecError, e:
+        print str(e)
+        sys.exit(e.status)
+
+    if profiler is not None:
+        profiler.report(sys.stderr)
+        if options.profileTrace:
+            profiler.write_trace(options.profileTrace)
 
 if __name__ == "__main__":
 	main()